@@ -1,21 +1,46 @@
 # app.py – Cloudi ☁️ AI Internship Chatbot - Simple Enhancements
 
+import asyncio
+import atexit
+import csv
+import gc
+import hashlib
+import heapq
 import json
 import difflib
+import fcntl
 import random
-import string
+import re
 import os
-import requests
-import openai
-from dotenv import load_dotenv
-from datetime import datetime
-from flask import Flask, session, redirect, url_for, request, render_template, flash
+import time
+import threading
+import io
+import marshal
+import cProfile
+import pstats
+import sqlite3
+import contextvars
+import zlib
+from bisect import bisect_left
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+from flask import Flask, session, redirect, url_for, request, render_template, flash, g, Response, jsonify
+from faq_index import FAQ_INDEX, normalize, IndexFile, SharedIndex, SpellIndex, tokens
 
-# Load environment variables
-load_dotenv()
+# Load environment variables (only pay for the dotenv import when there is a .env)
+if os.path.exists(".env"):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # Twilio (WhatsApp & SMS)
 TWILIO_SID = os.getenv("TWILIO_SID")
@@ -39,21 +64,1157 @@ INSTAGRAM_APP_SECRET = os.getenv("INSTAGRAM_APP_SECRET")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 
 # Check critical envs
-if not openai.api_key:
+if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY missing.")
 if not all([TWILIO_SID, TWILIO_TOKEN, TWILIO_PHONE]):
     raise ValueError("Twilio credentials missing.")
 if not app.secret_key:
     raise ValueError("FLASK_SECRET_KEY missing.")
 
-# ----------- Simple Improvements -----------
+# Optional bearer token so a Prometheus scraper can read /metrics without an admin session
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Optional SQLite file shared by all workers on a host (rate limits etc.);
+# without it every worker keeps its own in-memory state
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB")
+
+# Token buckets per sender: cheap local answers vs. expensive GPT fallbacks
+RATE_LOCAL_CAPACITY = float(os.getenv("RATE_LOCAL_CAPACITY", "20"))
+RATE_LOCAL_PER_MINUTE = float(os.getenv("RATE_LOCAL_PER_MINUTE", "20"))
+RATE_LLM_CAPACITY = float(os.getenv("RATE_LLM_CAPACITY", "5"))
+RATE_LLM_PER_MINUTE = float(os.getenv("RATE_LLM_PER_MINUTE", "3"))
+# Reverse proxies in front of the app (Render's load balancer is one): the
+# client address is read from their X-Forwarded-For entries; 0 trusts none
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+# FAQ confidence bands: at or above HIGH answer directly, between SUGGEST and
+# HIGH answer locally with "Did you mean…", below SUGGEST fall back to GPT
+FAQ_HIGH_CUTOFF = float(os.getenv("FAQ_HIGH_CUTOFF", "0.85"))
+FAQ_SUGGEST_CUTOFF = float(os.getenv("FAQ_SUGGEST_CUTOFF", "0.75"))
+FAQ_MAX_SUGGESTIONS = 3
+
+# How long a provider message id is remembered to drop webhook redeliveries
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))
+
+# Twilio gives up on a webhook after 15s; answer inline only if ready by then
+SMS_DEADLINE_SECONDS = float(os.getenv("SMS_DEADLINE_SECONDS", "10"))
+
+# Token budget for earlier turns sent along with a GPT fallback
+GPT_CONTEXT_TOKENS = int(os.getenv("GPT_CONTEXT_TOKENS", "600"))
+
+# How long browsers may reuse the static chat page shells (/ and /widget)
+PAGE_CACHE_SECONDS = int(os.getenv("PAGE_CACHE_SECONDS", "300"))
+
+# Name of a shared memory segment to hold the FAQ index once for all workers;
+# without it each worker maps faq_index.bin (shared through the page cache)
+FAQ_SHARED_MEMORY = os.getenv("FAQ_SHARED_MEMORY")
+
+# Optional tenants.json: other programmes' FAQ sets, served by this same deployment
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+# Opened FAQ indexes beyond this are closed, least recently used first
+TENANT_MEMORY_BUDGET_MB = float(os.getenv("TENANT_MEMORY_BUDGET_MB", "256"))
+
+# LLM routing: the model and reply length follow the channel and question length
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", LLM_MODEL)  # short routes, and any route running slow
+LLM_LONG_QUERY_CHARS = int(os.getenv("LLM_LONG_QUERY_CHARS", "160"))
+# LLM_STUB=1 answers from a local stub instead of OpenAI (offline development, load tests)
+LLM_STUB = os.getenv("LLM_STUB") == "1"
+LLM_STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", "0"))
+
+# Heavy-hitter tracking of GPT fallback questions for /analytics
+TRENDING_CAPACITY = int(os.getenv("TRENDING_CAPACITY", "200"))
+TRENDING_FLUSH_SECONDS = float(os.getenv("TRENDING_FLUSH_SECONDS", "60"))
+
+# Off-peak pre-warming of GPT answers for the top trending fallback questions
+PREWARM_HOURS = os.getenv("PREWARM_HOURS", "2-6")  # local hours, start-end; empty disables the job
+PREWARM_TOP = int(os.getenv("PREWARM_TOP", "50"))
+# Only recent demand counts: fallback counts halve every PREWARM_HALF_LIFE_HOURS
+PREWARM_HALF_LIFE_HOURS = float(os.getenv("PREWARM_HALF_LIFE_HOURS", "24"))
+PREWARM_ROUTES = [name.strip() for name in os.getenv("PREWARM_ROUTES", "web_quick,messaging,sms").split(",") if name.strip()]
+PREWARM_INTERVAL_SECONDS = float(os.getenv("PREWARM_INTERVAL_SECONDS", "5"))  # pause between GPT calls
+PREWARM_DAILY_BUDGET = int(os.getenv("PREWARM_DAILY_BUDGET", "100"))  # GPT calls per day, all workers together
+WARM_ANSWER_TTL_HOURS = float(os.getenv("WARM_ANSWER_TTL_HOURS", "24"))
+
+# ----------- Metrics (per-stage latency) -----------
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names, values, extra=""):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self, worker=""):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, labels, worker)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self, worker=""):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        bucket_label = f"{worker}," if worker else ""
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, f'{bucket_label}le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += counts[-1]
+            inf = _format_labels(self.label_names, labels, f'{bucket_label}le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels, worker)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels, worker)} {cumulative}")
+        return lines
+
+STAGE_SECONDS = Histogram("cloudi_stage_seconds", "Time spent in each stage of answering a message.", ("stage", "channel", "tier"))
+REQUEST_SECONDS = Histogram("cloudi_request_seconds", "End-to-end time to answer a message.", ("channel", "tier"))
+RESPONSES_TOTAL = Counter("cloudi_responses_total", "Messages answered, by channel and matched tier.", ("channel", "tier"))
+THROTTLED_TOTAL = Counter("cloudi_throttled_total", "Messages refused by the per-sender rate limiter.", ("bucket",))
+DUPLICATES_TOTAL = Counter("cloudi_webhook_duplicates_total", "Webhook redeliveries answered from the dedup cache.", ("channel",))
+LLM_SECONDS = Histogram("cloudi_llm_seconds", "LLM completion time by route and model.", ("route", "model"))
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, RESPONSES_TOTAL, THROTTLED_TOTAL, DUPLICATES_TOTAL, LLM_SECONDS]
+
+# Stage timings are buffered per request and only observed once the matched
+# tier is known, so every stage can be labelled with it. A ContextVar keeps
+# traces apart both across threads and across asyncio tasks (see asgi.py).
+# Work handed to a background pool keeps the trace; stages that end after the
+# request has finished are observed at once, with its channel and final tier.
+_trace = ContextVar("cloudi_trace", default=None)
+_trace_lock = threading.Lock()
+
+@contextmanager
+def request_trace(channel):
+    trace = {"channel": channel, "tier": "none", "stages": [], "done": False}
+    token = _trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        elapsed = time.perf_counter() - start
+        with _trace_lock:
+            trace["done"] = True
+            tier = trace["tier"]
+            stages = trace["stages"]
+        for stage, seconds in stages:
+            STAGE_SECONDS.observe((stage, channel, tier), seconds)
+        REQUEST_SECONDS.observe((channel, tier), elapsed)
+        RESPONSES_TOTAL.inc((channel, tier))
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        trace = _trace.get()
+        if trace is None:
+            STAGE_SECONDS.observe((stage, "none", "none"), elapsed)
+        else:
+            observe_stage(trace, stage, elapsed)
+
+def observe_stage(trace, stage, seconds):
+    with _trace_lock:
+        if not trace["done"]:
+            trace["stages"].append((stage, seconds))
+            return
+    STAGE_SECONDS.observe((stage, trace["channel"], trace["tier"]), seconds)
+
+def set_tier(tier):
+    trace = _trace.get()
+    if trace is not None:
+        with _trace_lock:
+            if not trace["done"]:
+                trace["tier"] = tier
+
+def render_metrics():
+    # Each worker only counts what it served itself, so every series carries
+    # its pid; aggregate across workers in the query, e.g. sum without (pid)
+    worker = f'pid="{os.getpid()}"'
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(worker))
+    return "\n".join(lines) + "\n"
+
+# ----------- Lazy provider imports -----------
+
+# openai and requests are only imported on first use, so workers that only
+# serve FAQ/casual answers never pay for them at startup.
+_providers = {}
+
+def get_openai():
+    if "openai" not in _providers:
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        _providers["openai"] = openai
+    return _providers["openai"]
+
+def get_http():
+    if "requests" not in _providers:
+        import requests
+        _providers["requests"] = requests
+    return _providers["requests"]
+
+def get_async_http():
+    # One pooled client per process, used by the async serving mode (asgi.py)
+    if "httpx" not in _providers:
+        import httpx
+        _providers["httpx"] = httpx.AsyncClient(timeout=30)
+    return _providers["httpx"]
+
+def get_brotli():
+    # Optional: without the brotli package responses are gzip-compressed only
+    if "brotli" not in _providers:
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        _providers["brotli"] = brotli
+    return _providers["brotli"]
+
+class StubChatCompletion:
+    """Stands in for openai.ChatCompletion when LLM_STUB=1: canned replies, no network."""
+
+    @staticmethod
+    def _reply(request):
+        question = request["messages"][-1]["content"]
+        text = f"[stub {request['model']}] You asked: {question}"
+        text = text[:request.get("max_tokens", 256) * 4]  # ~4 characters per token
+        return SimpleNamespace(choices=[SimpleNamespace(message={"role": "assistant", "content": text})])
+
+    @classmethod
+    def create(cls, **request):
+        time.sleep(LLM_STUB_LATENCY)
+        return cls._reply(request)
+
+    @classmethod
+    async def acreate(cls, **request):
+        await asyncio.sleep(LLM_STUB_LATENCY)
+        return cls._reply(request)
+
+def get_chat_completion():
+    return StubChatCompletion if LLM_STUB else get_openai().ChatCompletion
+
+async def close_async_http():
+    client = _providers.pop("httpx", None)
+    if client is not None:
+        await client.aclose()
+
+# ----------- Profiling (admin-controlled sampling) -----------
+
+# Settings live in a small JSON file so every worker picks up what the admin
+# chose; each worker re-reads it at most every PROFILE_SETTINGS_TTL seconds.
+PROFILE_SETTINGS_FILE = "profiling.json"
+PROFILE_SETTINGS_TTL = 5
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "20"))
+# Finished profiles are files here, shared by all workers: <id>.json (listing
+# and summary) and <id>.prof (raw stats); only the newest PROFILE_RING_SIZE stay
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_ID = re.compile(r"\d+-\d+")
+
+_profile_lock = threading.Lock()  # at most one profiled request per worker at a time
+_profile_settings = {"sample_rate": 0.0, "route": "", "loaded_at": 0.0, "mtime": None}
+
+def get_profile_settings():
+    now = time.monotonic()
+    if now - _profile_settings["loaded_at"] < PROFILE_SETTINGS_TTL:
+        return _profile_settings
+    _profile_settings["loaded_at"] = now
+    try:
+        mtime = os.path.getmtime(PROFILE_SETTINGS_FILE)
+    except OSError:
+        _profile_settings.update(sample_rate=0.0, route="", mtime=None)
+        return _profile_settings
+    if mtime != _profile_settings["mtime"]:
+        try:
+            with open(PROFILE_SETTINGS_FILE, "r") as f:
+                data = json.load(f)
+            _profile_settings.update(
+                sample_rate=min(max(float(data.get("sample_rate", 0)), 0.0), 1.0),
+                route=data.get("route", ""),
+                mtime=mtime
+            )
+        except (ValueError, OSError) as e:
+            print(f"Error loading profiling settings: {e}")
+    return _profile_settings
+
+def save_profile_settings(sample_rate, route):
+    with open(PROFILE_SETTINGS_FILE, "w") as f:
+        json.dump({"sample_rate": sample_rate, "route": route}, f, indent=4)
+    _profile_settings["loaded_at"] = 0.0
+
+@app.before_request
+def start_profiling():
+    settings = get_profile_settings()
+    if settings["sample_rate"] <= 0 or request.path.startswith("/admin/profil"):
+        return
+    if settings["route"] and not request.path.startswith(settings["route"]):
+        return
+    if request.environ.get("cloudi.event_loop"):
+        # asgi.py's routes share the event loop thread: cProfile would catch every other coroutine too
+        return
+    if random.random() >= settings["sample_rate"]:
+        return
+    if not _profile_lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiling tool is active
+        _profile_lock.release()
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+@app.teardown_request
+def stop_profiling(exc=None):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        elapsed = time.perf_counter() - g.pop("profile_started")
+    finally:
+        _profile_lock.release()
+
+    profiler.create_stats()
+    raw_stats = marshal.dumps(profiler.stats)  # pstats.Stats() below empties profiler.stats
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(30)
+    save_profile({
+        "id": f"{time.time_ns()}-{os.getpid()}",
+        "pid": os.getpid(),
+        "method": request.method,
+        "path": request.path,
+        "seconds": round(elapsed, 4),
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "summary": summary.getvalue()
+    }, raw_stats)
+
+def profile_ids():
+    """Stored profile ids, newest first (ids start with the time they were taken)."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    ids = [name[:-len(".json")] for name in names if name.endswith(".json")]
+    return sorted(ids, key=lambda profile_id: int(profile_id.split("-")[0]), reverse=True)
+
+def save_profile(profile, raw_stats):
+    base = os.path.join(PROFILE_DIR, profile["id"])
+    tmp_path = f"{base}.tmp"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(raw_stats)
+        os.replace(tmp_path, f"{base}.prof")
+        # The .json goes last: a listed profile always has its stats
+        with open(tmp_path, "w") as f:
+            json.dump(profile, f)
+        os.replace(tmp_path, f"{base}.json")
+        for stale in profile_ids()[PROFILE_RING_SIZE:]:
+            for ext in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, stale + ext))
+                except FileNotFoundError:
+                    pass  # another worker pruned it first
+    except OSError as e:
+        print(f"Error saving profile: {e}")
+
+def find_profile(profile_id):
+    if not PROFILE_ID.fullmatch(profile_id):
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_profiles():
+    found = (find_profile(profile_id) for profile_id in profile_ids())
+    return [profile for profile in found if profile is not None]
+
+# ----------- Shared state (optional, cross-worker) -----------
+
+_db_local = threading.local()
+
+def shared_db():
+    # One connection per thread; opened lazily so none leaks across a fork
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SHARED_STATE_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "bucket TEXT, identity TEXT, tokens REAL, updated REAL, "
+            "PRIMARY KEY (bucket, identity))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "identity TEXT PRIMARY KEY, turns TEXT, updated REAL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_deliveries ("
+            "message_key TEXT PRIMARY KEY, result TEXT, created REAL)"
+        )
+        _db_local.conn = conn
+    return conn
+
+# ----------- Rate limiting (per-sender token buckets) -----------
+
+THROTTLED_REPLY = "Whoa, that's a lot of messages! ☁️ Please wait a moment before asking again."
+LLM_THROTTLED_REPLY = "I've looked up lots of new answers for you already! 🤔 Give me a minute before asking something new. ☁️"
+
+class TokenBucket:
+    MAX_IDENTITIES = 10000  # in-memory mode forgets the least recently seen senders
+
+    def __init__(self, name, capacity, per_minute, count_refusals=True):
+        self.name = name
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.count_refusals = count_refusals
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, updated, now):
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return True, tokens - 1
+        return False, tokens
+
+    def allow(self, identity):
+        now = time.time()
+        if SHARED_STATE_DB:
+            allowed = self._allow_shared(identity, now)
+        else:
+            with self._lock:
+                tokens, updated = self._buckets.pop(identity, (self.capacity, now))
+                allowed, tokens = self._take(tokens, updated, now)
+                self._buckets[identity] = (tokens, now)  # re-insert: dict order is recency
+                if len(self._buckets) > self.MAX_IDENTITIES:
+                    del self._buckets[next(iter(self._buckets))]
+        if not allowed and self.count_refusals:
+            THROTTLED_TOTAL.inc((self.name,))
+        return allowed
+
+    def _allow_shared(self, identity, now):
+        conn = shared_db()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT tokens, updated FROM rate_buckets WHERE bucket = ? AND identity = ?",
+                (self.name, identity)
+            ).fetchone()
+            tokens, updated = row if row else (self.capacity, now)
+            allowed, tokens = self._take(tokens, updated, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?, ?)",
+                (self.name, identity, tokens, now)
+            )
+            if random.random() < 0.001:
+                # Idle buckets are full again anyway, so old rows can go
+                conn.execute("DELETE FROM rate_buckets WHERE updated < ?", (now - 3600,))
+            conn.execute("COMMIT")
+            return allowed
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"Rate limit store error: {e}")
+            return True  # fail open rather than block everyone
+
+local_limiter = TokenBucket("local", RATE_LOCAL_CAPACITY, RATE_LOCAL_PER_MINUTE)
+llm_limiter = TokenBucket("llm", RATE_LLM_CAPACITY, RATE_LLM_PER_MINUTE)
+# One throttle notice per sender each time the local bucket could refill completely
+throttle_notices = TokenBucket("notice", 1, RATE_LOCAL_PER_MINUTE / RATE_LOCAL_CAPACITY, count_refusals=False)
+
+def allow_message(identity):
+    with timed("rate_limit"):
+        allowed = local_limiter.allow(identity)
+    if not allowed:
+        set_tier("throttled")
+    return allowed
+
+def throttled_reply(identity):
+    """THROTTLED_REPLY for a sender's first refused message in a while; None for the rest (acknowledge silently)."""
+    return THROTTLED_REPLY if throttle_notices.allow(identity) else None
+
+def client_ip():
+    """The client's address as seen by the outermost trusted proxy (like werkzeug's ProxyFix)."""
+    forwarded = request.access_route if "X-Forwarded-For" in request.headers else []
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr
+
+def web_identity():
+    # Brand-new sessions are charged to the client IP, so dropping the
+    # cookie on every request doesn't reset the bucket
+    if "sid" not in session:
+        session["sid"] = os.urandom(8).hex()
+        return f"ip:{client_ip()}"
+    return f"web:{session['sid']}"
+
+# ----------- Background work -----------
+
+# SMS GPT fallbacks race the webhook deadline here (and finish here if they miss it)
+background = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cloudi-bg")
+# JSON log rewrites go through a single thread so they never interleave
+log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cloudi-log")
+
+def submit_in_context(executor, fn, *args):
+    # Carry the request trace along: stages that finish after the request
+    # are observed under its channel and tier (see timed())
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# ----------- Handler flows (shared by the WSGI views and asgi.py) -----------
+
+# Each chat/webhook handler is written once, as a generator. Wherever it would
+# block it yields the call instead - (function, *args) - and gets the result
+# sent back, or the exception thrown in. run_flow() makes those calls
+# directly; asgi.py awaits an async twin where there is one and runs the rest
+# in a worker thread, so the event loop never waits on SQLite, files or HTTP.
+
+def run_flow(flow):
+    result, error = None, None
+    while True:
+        try:
+            call = flow.throw(error) if error is not None else flow.send(result)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = call[0](*call[1:]), None
+        except Exception as e:
+            result, error = None, e
+
+# ----------- Webhook idempotency (provider message id dedup) -----------
+
+class DeliveryLog:
+    """TTL set of provider message ids, remembering the reply sent for each.
+
+    claim() returns (True, None) for a first delivery; the caller must then
+    complete() it with the reply, or release() it if handling failed so a
+    retry can try again. A redelivery gets (False, reply) - reply is None
+    while the first delivery is still being answered.
+    """
+    MAX_ENTRIES = 10000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        now = time.time()
+        if SHARED_STATE_DB:
+            return self._claim_shared(key, now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                return False, entry[1]
+            self._entries[key] = (now, None)
+            while len(self._entries) > self.MAX_ENTRIES:
+                del self._entries[next(iter(self._entries))]
+        return True, None
+
+    def _claim_shared(self, key, now):
+        conn = shared_db()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM webhook_deliveries WHERE created < ?", (now - self.ttl,))
+            row = conn.execute("SELECT result FROM webhook_deliveries WHERE message_key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO webhook_deliveries VALUES (?, NULL, ?)", (key, now))
+            conn.execute("COMMIT")
+            return (True, None) if row is None else (False, row[0])
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"Dedup store error: {e}")
+            return True, None
+
+    def complete(self, key, result):
+        if SHARED_STATE_DB:
+            try:
+                shared_db().execute("UPDATE webhook_deliveries SET result = ? WHERE message_key = ?", (result, key))
+            except sqlite3.Error as e:
+                print(f"Dedup store error: {e}")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (self._entries[key][0], result)
+
+    def release(self, key):
+        if SHARED_STATE_DB:
+            try:
+                shared_db().execute("DELETE FROM webhook_deliveries WHERE message_key = ?", (key,))
+            except sqlite3.Error as e:
+                print(f"Dedup store error: {e}")
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+
+webhook_deliveries = DeliveryLog(WEBHOOK_DEDUP_TTL)
+
+def claim_delivery(channel, message_id):
+    """Return (key, previous_reply); key is None if this delivery was already handled."""
+    if not message_id:
+        return "", None  # nothing to dedup on, always handle it
+    key = f"{channel}:{message_id}"
+    with timed("dedup"):
+        claimed, previous = webhook_deliveries.claim(key)
+    if claimed:
+        return key, None
+    set_tier("duplicate")
+    DUPLICATES_TOTAL.inc((channel,))
+    return None, previous
+
+def finish_delivery(key, reply):
+    if key:
+        webhook_deliveries.complete(key, reply)
+
+def abandon_delivery(key):
+    if key:
+        webhook_deliveries.release(key)
+
+# ----------- Conversation context (for the GPT fallback) -----------
+
+HISTORY_TURNS = 8
+CONTEXT_ANSWER_CHARS = 280
+MAX_CONVERSATIONS = 5000  # in-memory mode forgets the least recently active senders
+
+_conversations = {}
+_conversations_lock = threading.Lock()
+
+def estimate_tokens(text):
+    # ~4 characters per token for English; close enough to budget a prompt
+    return len(text) // 4 + 1
+
+def summarize_answer(text, limit=CONTEXT_ANSWER_CHARS):
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(". ", 0, limit)
+    return text[:cut + 1] if cut > limit // 2 else text[:limit].rstrip() + "…"
+
+def build_context(history, budget=None):
+    """Turn recent history into chat messages, newest first until the token budget runs out."""
+    budget = GPT_CONTEXT_TOKENS if budget is None else budget
+    messages = []
+    used = 0
+    for turn in reversed(history):
+        if turn.get("faq"):
+            # The model doesn't need the FAQ text again, just what was asked about
+            answer = f'[Answered from the FAQ entry "{turn["faq"]}"]'
+        else:
+            answer = summarize_answer(turn["answer"])
+        cost = estimate_tokens(turn["question"]) + estimate_tokens(answer) + 8  # + per-message overhead
+        if used + cost > budget:
+            break
+        used += cost
+        messages[:0] = [
+            {"role": "user", "content": turn["question"]},
+            {"role": "assistant", "content": answer}
+        ]
+    return messages
+
+def load_conversation(identity):
+    """Recent turns for an SMS/WhatsApp/Messenger sender (the web keeps them in the session)."""
+    if SHARED_STATE_DB:
+        try:
+            row = shared_db().execute("SELECT turns FROM conversations WHERE identity = ?", (identity,)).fetchone()
+            return json.loads(row[0]) if row else []
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Conversation store error: {e}")
+            return []
+    with _conversations_lock:
+        return list(_conversations.get(identity, []))
+
+def remember_turn(identity, question, answer, faq_key=None):
+    turn = {"question": question, "answer": summarize_answer(answer)}
+    if faq_key:
+        turn["faq"] = faq_key
+    if SHARED_STATE_DB:
+        try:
+            turns = (load_conversation(identity) + [turn])[-HISTORY_TURNS:]
+            shared_db().execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                (identity, json.dumps(turns), time.time())
+            )
+        except sqlite3.Error as e:
+            print(f"Conversation store error: {e}")
+        return
+    with _conversations_lock:
+        turns = _conversations.pop(identity, [])
+        _conversations[identity] = (turns + [turn])[-HISTORY_TURNS:]
+        if len(_conversations) > MAX_CONVERSATIONS:
+            del _conversations[next(iter(_conversations))]
+
+# ----------- Trending fallback questions (heavy hitters) -----------
+
+class SpaceSaving:
+    """Space-Saving top-k counter: fixed memory, O(1) per update.
+
+    Keys are filed by count in a stream summary (count -> keys), so an update
+    moves one key up one bucket and eviction takes the oldest key from the
+    lowest bucket. A key's true count lies between count - error and count.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self._counts = {}
+        self._errors = {}
+        self._labels = {}
+        self._buckets = {}  # count -> {key: None}, oldest first
+        self._min_count = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key, label):
+        count = self._counts.get(key)
+        if count is None:
+            count = 0
+            if len(self._counts) >= self.capacity:
+                # The newcomer replaces the least counted key and inherits its count as error
+                count = self._min_count
+                evicted = next(iter(self._buckets[count]))
+                self._unlink(evicted, count)
+                del self._counts[evicted], self._errors[evicted], self._labels[evicted]
+            self._errors[key] = count
+            self._labels[key] = label
+        else:
+            self._unlink(key, count)
+
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, {})[key] = None
+        if count == 0:
+            self._min_count = 1
+        elif count == self._min_count and count not in self._buckets:
+            self._min_count = count + 1
+
+    def _unlink(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def entries(self):
+        """All tracked keys, highest count first."""
+        ranked = sorted(self._counts.items(), key=itemgetter(1), reverse=True)
+        return [
+            {"key": key, "question": self._labels[key], "count": count, "error": self._errors[key]}
+            for key, count in ranked
+        ]
+
+class TrendingQuestions:
+    """Counts GPT fallbacks in memory and merges them into a small JSON top list.
+
+    Each worker counts the questions it sent to GPT since its last flush;
+    flush() folds them into the stored list with the Space-Saving merge, so
+    the dashboard reads one small file instead of scanning learning_log.json.
+    With a half-life the stored counts decay (count and error alike, so the
+    bounds still hold) and questions nobody asks any more drop off the list.
+    """
+    MIN_DECAYED_COUNT = 0.5
+
+    def __init__(self, path, capacity, flush_seconds, half_life=None):
+        self.path = path
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.half_life = half_life
+        self._pending = SpaceSaving(capacity)
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()  # flock below serializes workers, this the threads
+
+    def record(self, question):
+        with self._lock:
+            self._pending.add(normalize(question), question)
+            due = time.time() - self._flushed_at >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return []
+
+    def _decayed(self, entries, now):
+        if not self.half_life:
+            return entries
+        kept = []
+        for entry in entries:
+            factor = 0.5 ** ((now - entry.get("at", now)) / self.half_life)
+            entry["count"] *= factor
+            entry["error"] *= factor
+            entry["at"] = now
+            if entry["count"] >= self.MIN_DECAYED_COUNT:
+                kept.append(entry)
+        return kept
+
+    def flush(self):
+        with self._lock:
+            pending_full = len(self._pending) >= self.capacity
+            pending = self._pending.entries()
+            self._pending.clear()
+            self._flushed_at = time.time()
+        if not pending:
+            return
+
+        # Every worker read-merge-replaces the same file, so hold the lock file throughout
+        with self._file_lock, open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            now = time.time()
+            stored = self._decayed(self.load(), now)
+            if self.half_life:
+                for entry in pending:
+                    entry["at"] = now
+            # A key missing from a full summary may still have up to that summary's lowest count
+            stored_min = stored[-1]["count"] if len(stored) >= self.capacity else 0
+            pending_min = pending[-1]["count"] if pending_full else 0
+
+            merged = {entry["key"]: entry for entry in stored}
+            for entry in merged.values():
+                entry["count"] += pending_min
+                entry["error"] += pending_min
+            for entry in pending:
+                previous = merged.get(entry["key"])
+                if previous is None:
+                    entry["count"] += stored_min
+                    entry["error"] += stored_min
+                    merged[entry["key"]] = entry
+                else:
+                    previous["count"] += entry["count"] - pending_min
+                    previous["error"] += entry["error"] - pending_min
+
+            ranked = sorted(merged.values(), key=itemgetter("count"), reverse=True)[:self.capacity]
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(ranked, f, indent=4)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Error saving trending questions: {e}")
+
+    def top(self, n):
+        self.flush()
+        return self._decayed(self.load(), time.time())[:n]
+
+trending_questions = TrendingQuestions("trending_questions.json", TRENDING_CAPACITY, TRENDING_FLUSH_SECONDS)
+atexit.register(trending_questions.flush)
+# The same counts, decaying: what is being asked lately, for the prewarm job
+recent_questions = TrendingQuestions(
+    "recent_questions.json", TRENDING_CAPACITY, TRENDING_FLUSH_SECONDS, PREWARM_HALF_LIFE_HOURS * 3600
+)
+atexit.register(recent_questions.flush)
+
+# ----------- LLM routing (per channel) -----------
+
+SYSTEM_PROMPT = "You're Cloudi ☁️, a friendly AI assistant helping with academic, career, and personal guidance."
+
+LlmRoute = namedtuple("LlmRoute", "name model max_tokens style target_seconds")
+
+LLM_ROUTES = {
+    "sms": LlmRoute("sms", LLM_FAST_MODEL, 90, "Reply in plain text, in at most 2 short sentences (under 300 characters): it is sent as an SMS.", 4.0),
+    "messaging": LlmRoute("messaging", LLM_FAST_MODEL, 180, "Reply in plain text and under 80 words: it is read in a messaging app.", 6.0),
+    "web_quick": LlmRoute("web_quick", LLM_MODEL, 300, "Keep responses helpful and under 120 words.", 8.0),
+    "web_full": LlmRoute("web_full", LLM_MODEL, 450, "Keep responses helpful and under 200 words.", 12.0),
+}
+CHANNEL_ROUTES = {"sms": "sms", "whatsapp": "messaging", "facebook": "messaging", "instagram": "messaging"}
+
+class RouteLatency:
+    """EWMA of each route's LLM latency, fed back into the route it runs with.
+
+    A route slower than its target loses max_tokens step by step (replies are
+    most of the latency), and switches to LLM_FAST_MODEL when well over it;
+    both recover once it is comfortably under target again. The length the
+    style asks for shrinks with max_tokens, so replies still end in one piece.
+    """
+    ALPHA = 0.2
+    MIN_SCALE = 0.4
+    MIN_TOKENS = 32
+    LENGTH_LIMIT = re.compile(r"under (\d+) (words|characters)")
+
+    def __init__(self):
+        self._ewma = {}
+        self._scale = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        target = LLM_ROUTES[name].target_seconds
+        with self._lock:
+            previous = self._ewma.get(name)
+            ewma = seconds if previous is None else previous + self.ALPHA * (seconds - previous)
+            scale = self._scale.get(name, 1.0)
+            if ewma > target:
+                scale = max(self.MIN_SCALE, scale * 0.85)
+            elif ewma < 0.6 * target:
+                scale = min(1.0, scale * 1.1)
+            self._ewma[name], self._scale[name] = ewma, scale
+
+    def adjust(self, route):
+        with self._lock:
+            ewma = self._ewma.get(route.name)
+            scale = self._scale.get(route.name, 1.0)
+        model = LLM_FAST_MODEL if ewma is not None and ewma > 1.5 * route.target_seconds else route.model
+        style = route.style
+        if scale < 1.0:
+            style = self.LENGTH_LIMIT.sub(lambda m: f"under {int(int(m.group(1)) * scale)} {m.group(2)}", style)
+        return route._replace(model=model, max_tokens=max(self.MIN_TOKENS, int(route.max_tokens * scale)), style=style)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: (self._ewma[name], self._scale[name]) for name in self._ewma}
+
+llm_latency = RouteLatency()
+
+def choose_llm_route(prompt):
+    """Pick the route for a fallback from the request's channel and the question's length."""
+    trace = _trace.get()
+    channel = trace["channel"] if trace else "web"
+    name = CHANNEL_ROUTES.get(channel)
+    if name is None:
+        name = "web_quick" if len(prompt) <= LLM_LONG_QUERY_CHARS else "web_full"
+    return llm_latency.adjust(LLM_ROUTES[name])
+
+@contextmanager
+def llm_call(route):
+    start = time.perf_counter()
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        elapsed = time.perf_counter() - start
+        LLM_SECONDS.observe((route.name, route.model), elapsed)
+        # Fast failures (rate limits, bad requests) say nothing about completion latency
+        if completed:
+            llm_latency.observe(route.name, elapsed)
+
+# ----------- Answer pre-warming -----------
+
+class WarmAnswers:
+    """GPT answers computed ahead of demand, keyed by route and normalized question.
+
+    Only the prewarm job writes the file (tmp file + os.replace); every
+    worker keeps the copy it last read and reloads it when the file changes.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._data = {"budget": {}, "answers": {}}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(route_name, question):
+        return f"{route_name}:{normalize(question)}"
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {"budget": {}, "answers": {}}
+
+    def current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self._data
+        with self._lock:
+            if mtime != self._mtime:
+                self._data, self._mtime = self.load(), mtime
+            return self._data
+
+    def save(self, data):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def get(self, route_name, question):
+        entry = self.current()["answers"].get(self.key(route_name, question))
+        if entry is None or entry["expires_at"] <= time.time():
+            return None
+        return entry["text"]
+
+    def warm_questions(self):
+        """Normalized questions with at least one unexpired answer."""
+        now = time.time()
+        return {
+            entry["question_key"] for entry in self.current()["answers"].values()
+            if entry["expires_at"] > now
+        }
+
+warm_answers = WarmAnswers("warm_answers.json", WARM_ANSWER_TTL_HOURS * 3600)
 
-def normalize(text):
-    if not text:
-        return ""
-    text = text.lower().strip()
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    return " ".join(text.split())
+def tidy_answer(text, route):
+    """Warm answers are served verbatim later: even out whitespace, keep SMS ones SMS-sized."""
+    lines = []
+    for line in text.strip().splitlines():
+        line = " ".join(line.split())
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    text = "\n".join(lines)
+    if route.name == "sms" and len(text) > 300:
+        text = text[:299].rsplit(" ", 1)[0] + "…"
+    return text
+
+def in_hours(window, hour):
+    """Whether an hour falls in a "start-end" window of local hours (may wrap past midnight)."""
+    if not window:
+        return False
+    start, end = (int(part) for part in window.split("-"))
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+class Prewarmer:
+    """Background job that answers trending fallback questions before users ask them.
+
+    Each worker runs a daemon thread that wakes every few minutes; inside
+    PREWARM_HOURS the one holding the lock file asks GPT the top questions of
+    recent_questions, one every PREWARM_INTERVAL_SECONDS, until the daily
+    budget is spent. Answers that are still fresh for half their TTL are
+    skipped.
+    """
+    CHECK_SECONDS = 300
+
+    def __init__(self, answers):
+        self.answers = answers
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        # Threads don't survive gunicorn's fork, so each worker starts its own on first use
+        if not PREWARM_HOURS or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop, name="cloudi-prewarm", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            if in_hours(PREWARM_HOURS, datetime.now().hour):
+                try:
+                    self.run()
+                except Exception as e:
+                    print(f"Prewarm error: {e}")
+            time.sleep(self.CHECK_SECONDS)
+
+    def run(self, off_peak_only=True):
+        """One pass over the recently trending questions; returns how many answers were warmed."""
+        with open(f"{self.answers.path}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0  # another worker is already warming
+            return self._warm(off_peak_only)
+
+    def _warm(self, off_peak_only):
+        data = self.answers.load()
+        today = datetime.now().strftime("%Y-%m-%d")
+        if data["budget"].get("day") != today:
+            data["budget"] = {"day": today, "calls": 0}
+        now = time.time()
+        data["answers"] = {key: entry for key, entry in data["answers"].items() if entry["expires_at"] > now}
+
+        warmed = 0
+        for item in recent_questions.top(PREWARM_TOP):
+            for route_name in PREWARM_ROUTES:
+                route = LLM_ROUTES[route_name]
+                key = self.answers.key(route_name, item["question"])
+                entry = data["answers"].get(key)
+                if entry is not None and entry["expires_at"] - time.time() > self.answers.ttl_seconds / 2:
+                    continue
+                if data["budget"]["calls"] >= PREWARM_DAILY_BUDGET:
+                    print(f"♨️ Prewarm budget spent: {warmed} answers warmed")
+                    return warmed
+                if off_peak_only and not in_hours(PREWARM_HOURS, datetime.now().hour):
+                    return warmed
+
+                data["budget"]["calls"] += 1
+                try:
+                    text = tidy_answer(llm_complete(item["question"], route=route), route)
+                except Exception as e:
+                    print(f"Prewarm error for {item['question']!r}: {e}")
+                    text = None
+                if text:
+                    warmed_at = time.time()
+                    data["answers"][key] = {
+                        "question": item["question"],
+                        "question_key": item["key"],
+                        "route": route_name,
+                        "model": route.model,
+                        "text": text,
+                        "warmed_at": warmed_at,
+                        "expires_at": warmed_at + self.answers.ttl_seconds,
+                    }
+                    warmed += 1
+                # Saved after every call so workers pick answers up (and the budget holds) mid-pass
+                self.answers.save(data)
+                time.sleep(PREWARM_INTERVAL_SECONDS)
+
+        if warmed:
+            print(f"♨️ Prewarmed {warmed} answers")
+        return warmed
+
+prewarmer = Prewarmer(warm_answers)
+
+@app.before_request
+def start_prewarmer():
+    prewarmer.start()
+
+@app.cli.command("prewarm")
+def prewarm_command():
+    """Warm answers for the trending questions now, within the daily budget."""
+    if not prewarmer.run(off_peak_only=False):
+        print("♨️ Nothing warmed: answers are fresh, the budget is spent, or another worker is warming")
+
+# ----------- Simple Improvements -----------
 
 def stylize_response(answer):
     prefixes = [
@@ -67,6 +1228,8 @@ def stylize_response(answer):
 
 # IMPROVEMENT 1: Better error handling for logging
 def log_unknown_question(question):
+    trending_questions.record(question)
+    recent_questions.record(question)
     log_file = 'learning_log.json'
     log_entry = {
         "question": question,
@@ -115,47 +1278,245 @@ def apply_personality(response, mood, prefix=True):
         return response
 
 # IMPROVEMENT 3: Better GPT error handling
-def get_fallback_from_gpt(prompt):
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You're Cloudi ☁️, a friendly AI assistant helping with academic, career, and personal guidance. Keep responses helpful and under 200 words."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message['content'].strip()
-    except openai.error.RateLimitError:
+def gpt_request(prompt, context=(), route=None):
+    route = route or LLM_ROUTES["web_full"]
+    return {
+        "model": route.model,
+        "max_tokens": route.max_tokens,
+        "messages": [
+            {"role": "system", "content": f"{SYSTEM_PROMPT} {route.style}"},
+            *context,
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+def gpt_error_reply(error):
+    openai = get_openai()
+    if isinstance(error, openai.error.RateLimitError):
         return "I'm getting lots of questions right now! Please try again in a moment. ☁️"
-    except openai.error.InvalidRequestError:
+    if isinstance(error, openai.error.InvalidRequestError):
         return "I didn't quite understand that. Could you rephrase your question? 🤔"
+    print("GPT error:", error)
+    return "Oops! I'm having trouble thinking right now. Please try again! ☁️💤"
+
+def llm_complete(prompt, context=(), route=None):
+    """One completion, errors raised; `route` defaults to the one chosen for this request."""
+    route = route or choose_llm_route(prompt)
+    with llm_call(route):
+        response = get_chat_completion().create(**gpt_request(prompt, context, route))
+    return response.choices[0].message['content'].strip()
+
+def get_fallback_from_gpt(prompt, context=()):
+    try:
+        return llm_complete(prompt, context)
     except Exception as e:
-        print("GPT error:", e)
-        return "Oops! I'm having trouble thinking right now. Please try again! ☁️💤"
+        return gpt_error_reply(e)
 
-def get_cloudi_response(user_input, mood="formal"):
+async def get_fallback_from_gpt_async(prompt, context=()):
+    route = choose_llm_route(prompt)
+    try:
+        with llm_call(route):
+            response = await get_chat_completion().acreate(**gpt_request(prompt, context, route))
+        return response.choices[0].message['content'].strip()
+    except Exception as e:
+        return gpt_error_reply(e)
+
+def scored_matches(word, possibilities, n=3, cutoff=0.6):
+    """Like difflib.get_close_matches, but returns (score, match) pairs, best first."""
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(word)
+    scored = []
+    for candidate in possibilities:
+        matcher.set_seq1(candidate)
+        if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+            score = matcher.ratio()
+            if score >= cutoff:
+                scored.append((score, candidate))
+    return heapq.nlargest(n, scored)
+
+def suggest_faq(candidates, mood, kb):
+    """Near-miss reply: the best candidate's answer plus the other close questions."""
+    best = candidates[0]
+    reply = f'Did you mean "{kb.questions.get(best, best)}"? 🤔\n\n{kb.faq[best]}'
+    others = [kb.questions.get(key, key) for key in candidates[1:]]
+    if others:
+        reply += "\n\nOr maybe you meant: " + " / ".join(others)
+    return apply_personality(reply, mood, prefix=False)
+
+def squeeze(word):
+    """Collapse runs of a repeated letter: "hiiii" -> "hi"."""
+    return "".join(letter for letter, _ in groupby(word))
+
+def plausible_typo(typed, word):
+    """Dropped, doubled or swapped letters ("thnks", "hii", "thnaks"), not another word ("cook" for "cool")."""
+    if len(typed) < len(word):
+        letters = iter(word)
+        return all(letter in letters for letter in typed)
+    if len(typed) > len(word):
+        return squeeze(typed) == squeeze(word)
+    return sorted(typed) == sorted(word)
+
+def correct_typos(normalized_input, kb):
+    """Swap each unknown word for the closest casual or FAQ word, when one is close enough.
+
+    Casual vocabulary is only reached from a short, casual-sized phrase and by
+    a plausible slip, so real words like "him", "now" or "cook" don't become
+    "hi", "how" or "cool".
+    """
+    words = tokens(normalized_input)
+    casual = len(words) <= CASUAL_MAX_WORDS
+    corrected = []
+    for token in words:
+        squeezed = squeeze(token)
+        if casual and squeezed != token and casual_spell.count(squeezed):
+            corrected.append(squeezed)  # "hii", "heyyy": the FAQ knows "hii" too, but it's still "hi"
+            continue
+        if casual_spell.count(token) or kb.spell.count(token):
+            corrected.append(token)
+            continue
+        candidates = []
+        for variant in dict.fromkeys((token, squeezed)):
+            for order, spell in enumerate((casual_spell, kb.spell)):
+                word, distance = spell.lookup(variant)
+                if word is None:
+                    continue
+                if casual_spell.count(word) and not (casual and plausible_typo(token, word)):
+                    continue
+                if len(token) <= 3 and not plausible_typo(token, word):
+                    continue  # short words have real neighbours: "see" is no typo of "fee"
+                candidates.append((distance, order, word))
+        corrected.append(min(candidates)[2] if candidates else token)
+    return " ".join(corrected)
+
+def find_casual(phrase, kb):
+    """Exact casual lookup, ignoring words like the bot's name ("hey cloudi" -> "hey").
+
+    The FAQ's own entries win over the filler stripping: "hi cloudi" has one.
+    """
+    if phrase in casual_keys:
+        return casual_keys[phrase]
+    if phrase in kb.faq:
+        return None
+    return casual_keys.get(" ".join(t for t in tokens(phrase) if t not in CASUAL_FILLER_WORDS))
+
+def faq_candidates(phrase, kb):
+    """FAQ keys sharing a meaningful word with the phrase; every key when none do."""
+    positions = set()
+    for token in tokens(phrase):
+        positions.update(kb.postings.get(token, ()))
+    if not positions:
+        return kb.faq.keys()
+    return [kb.keys[i] for i in sorted(positions)]
+
+# text is the reply; faq_key names the FAQ entry it came from, if any
+Answer = namedtuple("Answer", "text tier faq_key", defaults=(None,))
+
+def match_local(user_input, kb, mood="formal"):
+    """Answer from input validation, casual replies or `kb`'s FAQ; None means fall back to GPT."""
     # IMPROVEMENT 4: Add input validation
     valid, error_msg = is_valid_input(user_input)
     if not valid:
-        return error_msg
+        set_tier("invalid")
+        return Answer(error_msg, "invalid")
     
-    normalized_input = normalize(user_input)
-    casual_keys = list(casual_replies.keys())
-    closest_match = difflib.get_close_matches(normalized_input, casual_keys, n=1, cutoff=0.7)
-    if closest_match:
-        reply = casual_replies[closest_match[0]]
-        print("✅ Matched casual:", closest_match[0])
-        return apply_personality(reply, mood, prefix=False)
-
-    closest_match = difflib.get_close_matches(normalized_input, faq.keys(), n=1, cutoff=0.85)
-    if closest_match:
-        matched_answer = faq[closest_match[0]]
-        return apply_personality(matched_answer, mood, prefix=True)
-
-    log_unknown_question(user_input)
-    gpt_reply = get_fallback_from_gpt(user_input)
+    with timed("normalize"):
+        normalized_input = normalize(user_input)
+    with timed("spell"):
+        corrected_input = correct_typos(normalized_input, kb)
+    # A corrected phrase is only used if it then matches a casual reply exactly,
+    # or an FAQ entry better than the text as typed does
+    with timed("casual_match"):
+        casual_key = find_casual(normalized_input, kb)
+        if casual_key is None and corrected_input != normalized_input:
+            casual_key = find_casual(corrected_input, kb)
+        if casual_key is None and len(tokens(normalized_input)) > 1:
+            # Single words are left to the spell index, which knows "cook" isn't "cool"
+            closest_match = difflib.get_close_matches(normalized_input, casual_keys, n=1, cutoff=0.7)
+            casual_key = casual_keys[closest_match[0]] if closest_match else None
+    if casual_key is not None:
+        set_tier("casual")
+        reply = casual_replies[casual_key]
+        print("✅ Matched casual:", casual_key)
+        return Answer(apply_personality(reply, mood, prefix=False), "casual")
+
+    with timed("faq_match"):
+        matches = scored_matches(normalized_input, faq_candidates(normalized_input, kb), n=FAQ_MAX_SUGGESTIONS, cutoff=FAQ_SUGGEST_CUTOFF)
+        if corrected_input != normalized_input:
+            corrected = scored_matches(corrected_input, faq_candidates(corrected_input, kb), n=FAQ_MAX_SUGGESTIONS, cutoff=FAQ_SUGGEST_CUTOFF)
+            if corrected and (not matches or corrected[0][0] > matches[0][0]):
+                matches = corrected
+    if matches and matches[0][0] >= FAQ_HIGH_CUTOFF:
+        set_tier("faq")
+        best = matches[0][1]
+        return Answer(apply_personality(kb.faq[best], mood, prefix=True), "faq", best)
+    if matches:
+        # Close but not certain: still cheaper and faster to ask than to call GPT
+        set_tier("suggest")
+        candidates = [key for _, key in matches]
+        return Answer(suggest_faq(candidates, mood, kb), "suggest", candidates[0])
+
+    return None
+
+def warm_reply(user_input, mood):
+    """A pre-warmed GPT answer for this question on this request's route, if one is fresh."""
+    with timed("warm_cache"):
+        text = yield (warm_answers.get, choose_llm_route(user_input).name, user_input)
+    if text is None:
+        return None
+    set_tier("warm")
+    print("♨️ Warm answer for:", user_input)
+    return Answer(apply_personality(text, mood, prefix=True), "warm")
+
+def local_answer_flow(user_input, mood="formal"):
+    """Everything short of GPT: validation, casual replies, the FAQ and pre-warmed answers."""
+    # Opening a tenant's FAQ or re-reading warm_answers.json can block: both are yielded
+    kb = yield (current_knowledge,)
+    answer = match_local(user_input, kb, mood)
+    if answer is not None:
+        return answer
+    answer = yield from warm_reply(user_input, mood)
+    if answer is not None:
+        # Still counted, so the question keeps trending and stays warm
+        with timed("log_unknown"):
+            yield (log_unknown_question, user_input)
+    return answer
+
+def llm_answer_flow(user_input, mood="formal", identity=None, history=()):
+    """The GPT fallback, within the sender's LLM rate limit."""
+    if identity and not (yield (llm_limiter.allow, identity)):
+        set_tier("throttled")
+        return Answer(LLM_THROTTLED_REPLY, "throttled")
+
+    set_tier("gpt")
+    with timed("log_unknown"):
+        yield (log_unknown_question, user_input)
+    with timed("gpt"):
+        gpt_reply = yield (get_fallback_from_gpt, user_input, build_context(history))
     print("🤖 GPT fallback:", gpt_reply)
-    return apply_personality(gpt_reply, mood, prefix=True)
+    return Answer(apply_personality(gpt_reply, mood, prefix=True), "gpt")
+
+def answer_flow(user_input, mood="formal", identity=None, history=()):
+    """Work out the reply; `history` is earlier turns, used as context for GPT."""
+    answer = yield from local_answer_flow(user_input, mood)
+    if answer is None:
+        answer = yield from llm_answer_flow(user_input, mood, identity, history)
+    return answer
+
+def sender_answer_flow(user_input, identity):
+    """answer_flow for SMS/WhatsApp/Messenger, with per-sender conversation memory."""
+    history = yield (load_conversation, identity)
+    answer = yield from answer_flow(user_input, identity=identity, history=history)
+    yield (remember_turn, identity, user_input, answer.text, answer.faq_key)
+    return answer.text
+
+def resolve_answer(user_input, mood="formal", identity=None, history=()):
+    return run_flow(answer_flow(user_input, mood, identity, history))
+
+def get_cloudi_response(user_input, mood="formal", identity=None):
+    return resolve_answer(user_input, mood, identity).text
+
+def resolve_for_sender(user_input, identity):
+    return run_flow(sender_answer_flow(user_input, identity))
 
 # IMPROVEMENT 5: More casual replies
 casual_replies = {
@@ -184,45 +1545,96 @@ casual_replies = {
     "nice": "Thanks! I try my best! 😊"
 }
 
+# Typo-tolerant lookups: "Hii", "helo cloudi!" and "thnks" are answered here, never by GPT
+CASUAL_FILLER_WORDS = {"cloudi", "there", "bot", "dear", "please", "pls"}
+casual_keys = {normalize(k): k for k in casual_replies}
+CASUAL_MAX_WORDS = max(len(tokens(key)) for key in casual_keys) + 1  # room for a "cloudi" or "please"
+casual_spell = SpellIndex(
+    [token for key in casual_keys for token in tokens(key)] + sorted(CASUAL_FILLER_WORDS)
+)
+
 @app.route('/chat', methods=['POST'])
 def chat():
-    try:
-        original_input = request.form['message'].strip()
+    return run_flow(chat_flow())
+
+def chat_flow():
+    with request_trace("web"):
+        try:
+            original_input = request.form['message'].strip()
+            
+            # IMPROVEMENT 6: Check for empty input
+            if not original_input:
+                flash("Please type something before sending! 😊", "error")
+                return redirect(url_for('home'))
+            
+            identity = web_identity()
+            if not (yield (allow_message, identity)):
+                return throttled_chat(original_input)
+
+            mood = read_chat_mood()
+            response = exact_casual_reply(original_input)
+            is_casual = response is not None
+            faq_key = None
+            if not is_casual:
+                answer = yield from answer_flow(original_input, mood, identity, session.get("history", []))
+                response, faq_key = answer.text, answer.faq_key
+
+            # Analytics file writes and template rendering are blocking calls too
+            return (yield (finish_chat, original_input, response, mood, is_casual, faq_key))
         
-        # IMPROVEMENT 6: Check for empty input
-        if not original_input:
-            flash("Please type something before sending! 😊", "error")
+        except Exception as e:
+            print(f"Chat error: {e}")
+            flash("Something went wrong! Please try again. 🤖", "error")
             return redirect(url_for('home'))
-        
-        mood = request.form.get("personality") or session.get("personality", "formal")
-        session["personality"] = mood
 
-        lower_input = original_input.lower()
-        is_casual = lower_input in casual_replies
+def read_chat_mood(data=None):
+    data = request.form if data is None else data
+    mood = data.get("personality") or session.get("personality", "formal")
+    session["personality"] = mood
+    return mood
 
-        if is_casual:
-            response = casual_replies[lower_input]
-        else:
-            response = get_cloudi_response(original_input, mood)
+def exact_casual_reply(message):
+    reply = casual_replies.get(message.lower())
+    if reply is not None:
+        set_tier("casual")
+    return reply
 
+def record_turn(original_input, response, mood, faq_key=None):
+    with timed("analytics"):
         update_analytics(mood)
-        
-        # IMPROVEMENT 7: Better session history management
-        if "history" not in session:
-            session["history"] = []
-        
-        session["history"].append({
-            "question": original_input, 
-            "answer": response,
-            "timestamp": datetime.now().strftime("%H:%M")  # Show time
-        })
-        
-        # Keep only last 8 conversations (instead of unlimited)
-        if len(session["history"]) > 8:
-            session["history"] = session["history"][-8:]
-        
-        session.modified = True
+    
+    # IMPROVEMENT 7: Better session history management
+    if "history" not in session:
+        session["history"] = []
+    
+    entry = {
+        "question": original_input, 
+        "answer": response,
+        "timestamp": datetime.now().strftime("%H:%M")  # Show time
+    }
+    if faq_key:
+        entry["faq"] = faq_key  # lets the GPT context refer to it by key
+    session["history"].append(entry)
+    
+    # Keep only last 8 conversations (instead of unlimited)
+    if len(session["history"]) > 8:
+        session["history"] = session["history"][-8:]
+    
+    session.modified = True
+    return entry
 
+def throttled_chat(original_input):
+    return render_template(
+        "response.html",
+        question=original_input,
+        answer=THROTTLED_REPLY,
+        history=session.get("history", []),
+        is_casual=False
+    ), 429
+
+def finish_chat(original_input, response, mood, is_casual, faq_key=None):
+    record_turn(original_input, response, mood, faq_key)
+    with timed("render"):
         return render_template(
             "response.html",
             question=original_input,
@@ -230,11 +1642,192 @@ def chat():
             history=session["history"],
             is_casual=is_casual
         )
-    
-    except Exception as e:
-        print(f"Chat error: {e}")
-        flash("Something went wrong! Please try again. 🤖", "error")
-        return redirect(url_for('home'))
+
+# IMPROVEMENT 14: JSON chat API - returns only the new turn, the page appends it
+@app.route('/api/chat', methods=['POST'])
+def api_chat():
+    return run_flow(api_chat_flow())
+
+def api_chat_flow():
+    with request_trace("web"):
+        try:
+            # Accept either a JSON body or the same form fields as /chat
+            data = request.get_json(silent=True) or request.form
+            original_input = (data.get("message") or "").strip()
+            if not original_input:
+                return jsonify({"error": "Please type something before sending! 😊"}), 400
+
+            identity = web_identity()
+            if not (yield (allow_message, identity)):
+                return jsonify({"error": THROTTLED_REPLY}), 429
+
+            mood = read_chat_mood(data)
+            response = exact_casual_reply(original_input)
+            is_casual = response is not None
+            faq_key = None
+            if not is_casual:
+                answer = yield from answer_flow(original_input, mood, identity, session.get("history", []))
+                response, faq_key = answer.text, answer.faq_key
+
+            return (yield (finish_api_chat, original_input, response, mood, is_casual, faq_key))
+        except Exception as e:
+            print(f"Chat API error: {e}")
+            return jsonify({"error": "Something went wrong! Please try again. 🤖"}), 500
+
+def finish_api_chat(original_input, response, mood, is_casual, faq_key=None):
+    entry = record_turn(original_input, response, mood, faq_key)
+    return jsonify(dict(entry, is_casual=is_casual, personality=mood))
+
+@app.route('/api/history')
+def api_history():
+    # The cached shell at / loads the session's conversation from here, once
+    response = jsonify(session.get("history", []))
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+# ----------- HTTP caching and compression -----------
+
+COMPRESS_MIN_BYTES = 512
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "text/plain", "text/csv", "application/json", "application/javascript"}
+STATIC_MAX_AGE = 365 * 24 * 3600
+COMPRESSED_CACHE_SIZE = 64
+
+def _tree_version(*folders):
+    digest = hashlib.sha256()
+    for folder in folders:
+        for root, _, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f"{root}/{name}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return digest.hexdigest()[:12]
+
+# Rendered pages change with their data or with a deploy of templates/static files
+SITE_VERSION = _tree_version(os.path.join(app.root_path, app.template_folder), app.static_folder)
+
+_fingerprints = {}
+
+def static_fingerprint(filename):
+    """Short content hash of a static file, recomputed only when the file changes."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _fingerprints:
+        with open(path, "rb") as f:
+            _fingerprints[key] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return _fingerprints[key]
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # /static/style.css?v=<hash>: an edited file gets a new URL, so each URL can be cached forever
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        fingerprint = static_fingerprint(values["filename"])
+        if fingerprint:
+            values["v"] = fingerprint
+
+def file_stamps(*paths):
+    """(version, last modified) of the data files a page is rendered from."""
+    stamps, latest = [], 0.0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps.append((path, None))
+            continue
+        stamps.append((path, stat.st_mtime_ns, stat.st_size))
+        latest = max(latest, stat.st_mtime)
+    return stamps, latest
+
+def conditional_page(version, render, last_modified=None, public=False, max_age=0):
+    """Answer 304 when the client already has this version of the page; only render otherwise.
+
+    `version` is anything that changes whenever the page would (file stamps,
+    generations...). Private pages are revalidated on every view.
+    """
+    if not public and session.get("_flashes"):
+        return render()  # a one-off message is about to be shown
+
+    etag = hashlib.sha256(repr((SITE_VERSION, request.script_root, request.endpoint, version)).encode()).hexdigest()[:20]
+    modified = datetime.fromtimestamp(int(last_modified), timezone.utc) if last_modified else None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = bool(modified and request.if_modified_since and modified <= request.if_modified_since)
+
+    response = app.response_class(status=304) if fresh else app.make_response(render())
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    if public:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+def cache_page(render):
+    # The chat shells don't depend on the session, so browsers (and proxies) can reuse them
+    return conditional_page(None, render, public=True, max_age=PAGE_CACHE_SECONDS)
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if accepted["br"] and get_brotli() is not None:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def compress(data, encoding):
+    if encoding == "br":
+        return get_brotli().compress(data, quality=5)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    return compressor.compress(data) + compressor.flush()
+
+_compressed = OrderedDict()  # (etag, encoding) -> body, so an unchanged page is compressed once
+_compressed_lock = threading.Lock()
+
+@app.after_request
+def cache_and_compress(response):
+    if request.endpoint == "static" and request.args.get("v"):
+        if request.args["v"] == static_fingerprint(request.view_args["filename"]):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+    if response.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or (response.is_streamed and not response.direct_passthrough):
+        return response  # 304s have no body; streamed exports compress themselves (?gzip=1)
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    response.direct_passthrough = False  # static files: read them so they can be compressed
+    etag, weak = response.get_etag()
+    key = (etag, encoding) if etag and not weak else None
+    with _compressed_lock:
+        body = _compressed.get(key) if key else None
+    if body is None:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        body = compress(data, encoding)
+        if key:
+            with _compressed_lock:
+                _compressed[key] = body
+                while len(_compressed) > COMPRESSED_CACHE_SIZE:
+                    _compressed.popitem(last=False)
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)  # same content, different bytes
+    return response
 
 # IMPROVEMENT 8: Better SMS logging
 def save_sms_log(phone, message):
@@ -293,34 +1886,218 @@ def update_analytics(mood, source="web"):
     with open("analytics.json", "w") as f:
         json.dump(data, f, indent=4)
 
+# ----------- Knowledge bases (one FAQ set per tenant) -----------
+
+# The casual replies and the GPT fallback are shared; each tenant (programme)
+# only brings its own FAQ. Tenants come from tenants.json, e.g.
+#   {"iac": {"faq": "tenants/iac_faq.json", "hosts": ["iac.example.org"],
+#            "prefix": "/iac", "pages": ["<facebook page id>"], "numbers": ["+15551234567"]}}
+# and are picked by route prefix, then host, then the page or Twilio number
+# a webhook message was sent to. Everything else is the default tenant.
+
+DEFAULT_TENANT = "default"
+
+class KnowledgeBase:
+    """A tenant's FAQ: its index store plus the views the matchers read."""
+
+    def __init__(self, name, store):
+        self.name = name
+        self.store = store
+        self._use(store.index if store else None)
+
+    def _use(self, index):
+        self.index = index
+        if index is None:
+            self.faq, self.questions, self.keys, self.spell, self.postings = {}, {}, [], SpellIndex(), {}
+            self.size = 0
+            return
+        self.faq = index["faq"]
+        self.questions = index["questions"]
+        self.keys = index["keys"]
+        self.spell = index["spell"]
+        self.postings = index["postings"]
+        self.size = index["size"]
+
+    @property
+    def generation(self):
+        return self.store.generation if self.store else 0
+
+    def refresh(self):
+        """Switch to a newer generation if one was published; cheap when none was."""
+        if self.store is not None:
+            index = self.store.refresh()
+            if index is not self.index:
+                self._use(index)
+        return self
+
+    def reload(self):
+        """Rebuild from the tenant's FAQ file; every worker switches on its next message."""
+        if self.store is not None:
+            self._use(self.store.reload())
+
+def read_tenants(path):
+    try:
+        with open(path, "r") as f:
+            tenants = json.load(f)
+    except FileNotFoundError:
+        tenants = {}
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"⚠️ Could not read {path}: {e}")
+        tenants = {}
+    # The default tenant is always faq_data.json, whatever else is configured
+    tenants[DEFAULT_TENANT] = {**tenants.get(DEFAULT_TENANT, {}), "faq": "faq_data.json", "index": FAQ_INDEX}
+    return tenants
+
+class KnowledgeBases:
+    """Tenants' knowledge bases, opened on first use and closed LRU over the memory budget.
+
+    A knowledge base's size is its index payload - the mmap'd file or shared
+    memory segment - which is nearly all of what it costs. The default tenant
+    is never closed. Opening one may rebuild its index, so that happens
+    outside the lock, one opener per tenant; a failed open isn't kept, and
+    the tenant's next message tries again.
+    """
+
+    def __init__(self, tenants, budget_bytes):
+        self.tenants = tenants
+        self.budget = budget_bytes
+        self._open = OrderedDict()
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, name):
+        kb = self._open.get(name)
+        if kb is not None:
+            self._open.move_to_end(name)
+        return kb
+
+    def get(self, name):
+        with self._lock:
+            kb = self._cached(name)
+            if kb is not None:
+                return kb
+            guard = self._opening.setdefault(name, threading.Lock())
+
+        with guard:
+            with self._lock:
+                kb = self._cached(name)
+            if kb is not None:
+                return kb  # opened by whoever held the guard
+            kb = self._load(name)
+            with self._lock:
+                self._opening.pop(name, None)
+                if kb.store is not None:
+                    self._open[name] = kb
+                    self._evict()
+            return kb
+
+    def _load(self, name):
+        settings = self.tenants[name]
+        source = settings["faq"]
+        index_path = settings.get("index") or os.path.splitext(source)[0] + ".index.bin"
+        try:
+            if FAQ_SHARED_MEMORY:
+                segment = FAQ_SHARED_MEMORY if name == DEFAULT_TENANT else f"{FAQ_SHARED_MEMORY}-{name}"
+                store = SharedIndex(segment, source, index_path)
+            else:
+                store = IndexFile(source, index_path)
+        except Exception as e:
+            print(f"❌ Error loading FAQ for {name}: {e}")
+            return KnowledgeBase(name, None)
+        kb = KnowledgeBase(name, store)
+        print(f"📚 Opened FAQ for {name}: {len(kb.faq)} entries")
+        return kb
+
+    def _evict(self):
+        total = sum(kb.size for kb in self._open.values())
+        for name in list(self._open)[:-1]:  # never the one just opened
+            if total <= self.budget:
+                break
+            if name == DEFAULT_TENANT:
+                continue
+            total -= self._open.pop(name).size
+            print(f"♻️ Closed FAQ for {name} (over the memory budget)")
+
+    def opened(self):
+        with self._lock:
+            return list(self._open.values())
+
+tenants = read_tenants(TENANTS_FILE)
+tenant_hosts = {host.lower(): name for name, t in tenants.items() for host in t.get("hosts", ())}
+tenant_prefixes = {t["prefix"].rstrip("/"): name for name, t in tenants.items() if t.get("prefix", "").rstrip("/")}
+tenant_accounts = {
+    str(account): name for name, t in tenants.items() for account in (*t.get("pages", ()), *t.get("numbers", ()))
+}
+knowledge_bases = KnowledgeBases(tenants, TENANT_MEMORY_BUDGET_MB * 1024 * 1024)
+
+_tenant = ContextVar("tenant", default=DEFAULT_TENANT)
+
+def use_tenant(name):
+    _tenant.set(name if name in tenants else DEFAULT_TENANT)
+
+def current_knowledge():
+    return knowledge_bases.get(_tenant.get()).refresh()
+
+def tenant_prefix(path):
+    """The tenant route prefix `path` starts with, if any."""
+    for prefix in tenant_prefixes:
+        if path == prefix or path.startswith(prefix + "/"):
+            return prefix
+    return None
+
+class TenantPrefixMiddleware:
+    """Serve each tenant's pages under its prefix: /iac/chat is /chat with the "iac" FAQ."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        prefix = tenant_prefix(path)
+        if prefix:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + prefix
+            environ["PATH_INFO"] = path[len(prefix):] or "/"
+            environ["cloudi.tenant"] = tenant_prefixes[prefix]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
+
+@app.before_request
+def select_tenant():
+    host = request.host.split(":")[0].lower()
+    use_tenant(request.environ.get("cloudi.tenant") or tenant_hosts.get(host, DEFAULT_TENANT))
+
+def use_account_tenant(account):
+    """Webhooks: the page or number a message was sent to picks the tenant, when configured."""
+    account = (account or "").replace("whatsapp:", "")
+    if account in tenant_accounts:
+        use_tenant(tenant_accounts[account])
+
 # IMPROVEMENT 10: Load FAQ with better error handling
-try:
-    with open('faq_data.json', 'r') as file:
-        raw_faq = json.load(file)
-        faq = {normalize(k): v for k, v in raw_faq.items()}
-        print(f"✅ Loaded {len(faq)} FAQ entries")
-except FileNotFoundError:
+# The default FAQ is opened at import so `--preload` shares it; other tenants
+# open on first use. Indexes are read in place (the mmap'd faq_index.bin, or
+# shared memory with FAQ_SHARED_MEMORY) and rebuilt if stale.
+if not os.path.exists('faq_data.json'):
     print("⚠️ FAQ file not found, creating empty one...")
-    faq = {}
     # Create empty FAQ file
     with open('faq_data.json', 'w') as file:
         json.dump({"hello": "Hi there! Welcome to Cloudi!"}, file, indent=4)
-except Exception as e:
-    print(f"❌ Error loading FAQ: {e}")
-    faq = {}
+print(f"✅ Loaded {len(knowledge_bases.get(DEFAULT_TENANT).faq)} FAQ entries")
 
 # ----------- Routes (Minor Improvements) -----------
 
 @app.route('/')
 def home():
-    # IMPROVEMENT 11: Show some stats on home page
-    total_conversations = len(session.get("history", []))
-    return render_template(
+    # The shell is identical for every visitor; new turns arrive via /api/chat
+    return cache_page(lambda: render_template(
         "chat.html", 
         intro_message="Hi, I'm Cloudi ☁️!", 
-        sub_message="Ask anything about internships, IAC, domains, docs...",
-        conversation_count=total_conversations
-    )
+        sub_message="Ask anything about internships, IAC, domains, docs..."
+    ))
+
+@app.route('/widget')
+def widget():
+    return cache_page(lambda: render_template("floating-chat.html"))
 
 @app.route('/reset')
 def reset():
@@ -334,7 +2111,7 @@ def analytics():
     if not session.get("admin_logged_in"):
         return redirect("/admin-login")
 
-    try:
+    def render():
         with open("analytics.json", "r") as f:
             data = json.load(f)
         
@@ -344,12 +2121,88 @@ def analytics():
         
         return render_template("analytics.html", 
                              analytics=data,
-                             most_popular_personality=most_popular)
+                             most_popular_personality=most_popular,
+                             trending=trending_questions.top(10),
+                             warm=warm_answers.warm_questions(),
+                             knowledge=kb)
+
+    try:
+        kb = current_knowledge()
+        trending_questions.flush()
+        stamps, modified = file_stamps("analytics.json", trending_questions.path, warm_answers.path)
+        return conditional_page((stamps, kb.name, kb.generation), render, modified)
     except Exception as e:
         print(f"Analytics error: {e}")
         flash("Error loading analytics!", "error")
         return redirect("/admin-login")
 
+@app.route("/admin/faq/reload", methods=["POST"])
+def reload_faq():
+    """Rebuild this tenant's FAQ index; every worker switches to it on its next message."""
+    if not session.get("admin_logged_in"):
+        return redirect("/admin-login")
+    kb = current_knowledge()
+    try:
+        kb.reload()
+        print(f"🔄 Reloaded FAQ for {kb.name}: {len(kb.faq)} entries, generation {kb.generation}")
+    except Exception as e:
+        print(f"FAQ reload error: {e}")
+    return redirect(url_for("analytics"))
+
+@app.route("/metrics")
+def metrics():
+    token = request.headers.get("Authorization", "")
+    token_ok = METRICS_TOKEN and token == f"Bearer {METRICS_TOKEN}"
+    if not (token_ok or session.get("admin_logged_in")):
+        return "Forbidden", 403
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    if not session.get("admin_logged_in"):
+        return redirect("/admin-login")
+
+    if request.method == "POST":
+        try:
+            sample_rate = min(max(float(request.form.get("sample_rate", 0)), 0.0), 1.0)
+        except ValueError:
+            flash("Sample rate must be a number between 0 and 1!", "error")
+            return redirect(url_for("admin_profiling"))
+        route = request.form.get("route", "").strip()
+        save_profile_settings(sample_rate, route)
+        flash("Profiling settings saved! 🔬", "success")
+        return redirect(url_for("admin_profiling"))
+
+    settings = get_profile_settings()
+    return render_template(
+        "profiling.html",
+        settings=settings,
+        profiles=list_profiles(),
+        ring_size=PROFILE_RING_SIZE,
+        profile_dir=PROFILE_DIR
+    )
+
+@app.route("/admin/profiles/<profile_id>")
+def download_profile(profile_id):
+    if not session.get("admin_logged_in"):
+        return redirect("/admin-login")
+
+    profile = find_profile(profile_id)
+    if profile is None:
+        return "Profile not found", 404
+    if request.args.get("format") == "txt":
+        return Response(profile["summary"], mimetype="text/plain")
+    try:
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.prof"), "rb") as f:
+            raw_stats = f.read()
+    except OSError:
+        return "Profile not found", 404
+    return Response(
+        raw_stats,
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename=cloudi-{profile_id}.prof"}
+    )
+
 @app.route("/admin-login", methods=["GET", "POST"])
 def admin_login():
     if request.method == "POST":
@@ -368,14 +2221,18 @@ def sms_logs():
     if not session.get("admin_logged_in"):
         return redirect("/admin-login")
     
-    try:
-        with open('sms_logs.json', 'r') as file:
-            logs = json.load(file)
-        # Show newest first
-        logs.reverse()
-    except:
-        logs = []
-    return render_template('sms_logs.html', logs=logs, total_logs=len(logs))
+    def render():
+        try:
+            with open('sms_logs.json', 'r') as file:
+                logs = json.load(file)
+            # Show newest first
+            logs.reverse()
+        except:
+            logs = []
+        return render_template('sms_logs.html', logs=logs, sms_history=logs, total_logs=len(logs))
+
+    stamps, modified = file_stamps('sms_logs.json')
+    return conditional_page(stamps, render, modified)
 
 @app.route('/clear-sms-logs', methods=['POST'])
 def clear_sms_logs():
@@ -387,18 +2244,146 @@ def clear_sms_logs():
     flash("SMS logs cleared! 🗑️", "success")
     return redirect(url_for('sms_logs'))
 
+# ----------- Admin exports (streamed) -----------
+
+# dataset -> (file, CSV columns)
+EXPORTS = {
+    "sms-logs": ("sms_logs.json", ["timestamp", "phone", "message"]),
+    "sms-history": ("sms_history.json", ["timestamp", "from", "question", "answer"]),
+    "learning-log": ("learning_log.json", ["timestamp", "question"]),
+    "feedback": ("feedback.json", ["timestamp", "question", "answer", "feedback"]),
+}
+EXPORT_CHUNK_SIZE = 1 << 16
+
+def iter_json_array(path, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the items of a JSON array file one by one, reading it a chunk at a time."""
+    decoder = json.JSONDecoder()
+    try:
+        f = open(path, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        buffer, pos, opened, eof = "", 0, False, False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                if not opened:
+                    if buffer[pos] != "[":
+                        return
+                    opened = True
+                    pos += 1
+                    continue
+                if buffer[pos] == "]":
+                    return
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        return  # truncated file: stop at the last complete item
+                else:
+                    yield item
+                    continue
+            elif eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def export_rows(path, start=None, end=None):
+    # Timestamps are "YYYY-MM-DD HH:MM:SS", so dates compare as strings
+    for row in iter_json_array(path):
+        day = str(row.get("timestamp", ""))[:10]
+        if (start and day < start) or (end and day > end):
+            continue
+        yield row
+
+def csv_cell(value):
+    value = "" if value is None else str(value)
+    # Don't let spreadsheet apps run user-written text as a formula (phone numbers are fine)
+    if value[:1] in ("=", "+", "-", "@") and not value[1:].replace(" ", "").isdigit():
+        return "'" + value
+    return value
+
+def csv_chunks(rows, columns):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([csv_cell(row.get(column)) for column in columns])
+        if out.tell() >= EXPORT_CHUNK_SIZE:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+def ndjson_chunks(rows):
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, ensure_ascii=False) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(lines)
+            lines, size = [], 0
+    yield "".join(lines)
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def read_export_date(name):
+    value = request.args.get(name, "").strip()
+    if value:
+        datetime.strptime(value, "%Y-%m-%d")  # ValueError if malformed
+    return value or None
+
+@app.route("/admin/export")
+def admin_export():
+    """Stream a log as CSV or NDJSON: ?dataset=sms-logs&format=csv&from=2025-01-01&to=2025-12-31&gzip=1"""
+    if not session.get("admin_logged_in"):
+        return redirect("/admin-login")
+
+    dataset = request.args.get("dataset", "")
+    export_format = request.args.get("format", "csv")
+    if dataset not in EXPORTS:
+        return f"dataset must be one of: {', '.join(EXPORTS)}", 400
+    if export_format not in ("csv", "ndjson"):
+        return "format must be csv or ndjson", 400
+    try:
+        start, end = read_export_date("from"), read_export_date("to")
+    except ValueError:
+        return "from/to must be dates like 2025-01-31", 400
+
+    path, columns = EXPORTS[dataset]
+    rows = export_rows(path, start, end)
+    if export_format == "csv":
+        chunks, mimetype = csv_chunks(rows, columns), "text/csv"
+    else:
+        chunks, mimetype = ndjson_chunks(rows), "application/x-ndjson"
+    filename = f"cloudi-{dataset}.{export_format}"
+    if request.args.get("gzip"):
+        chunks, mimetype, filename = gzip_chunks(chunks), "application/gzip", filename + ".gz"
+
+    return Response(chunks, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store",
+    })
+
 @app.route("/logout", methods=["POST"])
 def logout():
     session.pop("admin_logged_in", None)
     flash("See you later! 👋", "success")
     return redirect("/admin-login")
 
-@app.route("/submit-feedback", methods=["POST"])
-def submit_feedback():
-    feedback = request.form.get("feedback")
-    question = request.form.get("question")
-    answer = request.form.get("answer")
-
+def save_feedback(question, answer, feedback):
+    """Append one entry to feedback.json; False if it couldn't be saved."""
     feedback_entry = {
         "question": question,
         "answer": answer,
@@ -422,16 +2407,105 @@ def submit_feedback():
         else:
             with open(feedback_file, "w") as f:
                 json.dump([feedback_entry], f, indent=4)
-
-        flash("✅ Thanks for your feedback! It really helps me improve.", "success")
+        return True
     except Exception as e:
         print(f"Feedback error: {e}")
+        return False
+
+@app.route("/submit-feedback", methods=["POST"])
+def submit_feedback():
+    if save_feedback(request.form.get("question"), request.form.get("answer"), request.form.get("feedback")):
+        flash("✅ Thanks for your feedback! It really helps me improve.", "success")
+    else:
         flash("Oops! Couldn't save your feedback. Please try again.", "error")
     
     return redirect(url_for("home"))
 
+# Same as /submit-feedback for the chat page's per-answer feedback, which posts via fetch
+@app.route("/api/feedback", methods=["POST"])
+def api_feedback():
+    data = request.get_json(silent=True) or request.form
+    feedback = (data.get("feedback") or "").strip()
+    if not feedback:
+        return jsonify({"error": "Please write some feedback before sending! 😊"}), 400
+    if not save_feedback(data.get("question"), data.get("answer"), feedback):
+        return jsonify({"error": "Oops! Couldn't save your feedback. Please try again."}), 500
+    return jsonify({"message": "✅ Thanks for your feedback! It really helps me improve."})
+
 # ----------- Webhooks (Same but with better error messages) -----------
 
+def read_facebook_message(data):
+    """Return (sender, text, mid) for a Messenger text message, or None for other events."""
+    messaging_event = data["entry"][0]["messaging"][0]
+    if "message" in messaging_event and "text" in messaging_event["message"]:
+        message = messaging_event["message"]
+        return messaging_event["sender"]["id"], message["text"], message.get("mid")
+    return None
+
+def read_twilio_message():
+    return request.values.get('Body', ''), request.values.get('From', ''), request.values.get('MessageSid')
+
+def record_sms(phone, user_input, reply):
+    with timed("sms_log"):
+        save_sms_log(phone, user_input)
+
+    log_entry = {
+        "from": phone,
+        "question": user_input,
+        "answer": reply,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+    sms_log_file = 'sms_history.json'
+    with timed("sms_history"):
+        logs = []
+        if os.path.exists(sms_log_file):
+            with open(sms_log_file, 'r') as f:
+                try:
+                    logs = json.load(f)
+                except:
+                    logs = []
+        logs.append(log_entry)
+        with open(sms_log_file, 'w') as f:
+            json.dump(logs, f, indent=4)
+
+def twiml_reply(reply):
+    if reply is None:
+        return "<Response></Response>"  # nothing to say (yet)
+    return f"<Response><Message>{escape(reply)}</Message></Response>"
+
+SMS_HOLDING_REPLY = "Great question! Let me look into it... ☁️ I'll text you the answer in a moment."
+
+def gpt_by_deadline(key, phone, user_input, identity, history):
+    """The GPT answer if it is ready within SMS_DEADLINE_SECONDS; otherwise None, and it is texted later."""
+    flow = llm_answer_flow(user_input, identity=identity, history=history)
+    future = submit_in_context(background, run_flow, flow)
+    try:
+        return future.result(timeout=SMS_DEADLINE_SECONDS)
+    except FutureTimeoutError:
+        # Done-callbacks run in the pool's own context; keep the request trace
+        context = contextvars.copy_context()
+        future.add_done_callback(lambda f: context.run(deliver_late_sms, key, phone, user_input, identity, f))
+        return None
+
+def deliver_late_sms(key, phone, user_input, identity, future):
+    """Done-callback for an answer that missed the webhook deadline: text it instead."""
+    try:
+        answer = future.result()
+        with timed("send"):
+            send_sms(phone, answer.text)
+    except Exception as e:
+        abandon_delivery(key)
+        print("Late SMS delivery error:", e)
+        return
+    # Sent: from here on a Twilio retry must get this reply, whatever happens to the logging
+    finish_delivery(key, answer.text)
+    try:
+        remember_turn(identity, user_input, answer.text)
+        submit_in_context(log_writer, record_sms, phone, user_input, answer.text)
+    except Exception as e:
+        print("Late SMS logging error:", e)
+
 @app.route("/webhook/facebook", methods=["GET", "POST"])
 def fb_webhook():
     if request.method == "GET":
@@ -439,26 +2513,59 @@ def fb_webhook():
             return request.args.get("hub.challenge")
         return "Invalid", 403
 
+    return run_flow(facebook_flow())
+
+def facebook_flow():
+    key = None
     try:
         data = request.get_json()
-        messaging_event = data["entry"][0]["messaging"][0]
-        if "message" in messaging_event and "text" in messaging_event["message"]:
-            sender = messaging_event["sender"]["id"]
-            user_input = messaging_event["message"]["text"]
-            reply = get_cloudi_response(user_input)
-            send_facebook_reply(sender, reply)
+        message = read_facebook_message(data)
+        if message:
+            sender, user_input, mid = message
+            use_account_tenant(data["entry"][0].get("id"))
+            with request_trace("facebook"):
+                key, _ = yield (claim_delivery, "facebook", mid)
+                if key is None:
+                    return "ok", 200  # redelivery: the reply was already sent
+                identity = f"facebook:{sender}"
+                if (yield (allow_message, identity)):
+                    reply = yield from sender_answer_flow(user_input, identity)
+                else:
+                    reply = yield (throttled_reply, identity)
+                if reply is not None:
+                    with timed("send"):
+                        yield (send_facebook_reply, sender, reply)
+                yield (finish_delivery, key, reply)
     except Exception as e:
+        yield (abandon_delivery, key)
         print("Facebook webhook error:", e)
     return "ok", 200
 
 @app.route("/webhook/whatsapp", methods=["POST"])
 def whatsapp_webhook():
+    return run_flow(whatsapp_flow())
+
+def whatsapp_flow():
+    key = None
     try:
-        user_input = request.values.get('Body', '')
-        phone = request.values.get('From', '').replace("whatsapp:", "")
-        reply = get_cloudi_response(user_input)
-        send_whatsapp_reply(phone, reply)
+        user_input, phone, message_sid = read_twilio_message()
+        phone = phone.replace("whatsapp:", "")
+        use_account_tenant(request.values.get("To"))
+        with request_trace("whatsapp"):
+            key, _ = yield (claim_delivery, "whatsapp", message_sid)
+            if key is None:
+                return "ok", 200  # redelivery: the reply was already sent
+            identity = f"whatsapp:{phone}"
+            if (yield (allow_message, identity)):
+                reply = yield from sender_answer_flow(user_input, identity)
+            else:
+                reply = yield (throttled_reply, identity)
+            if reply is not None:
+                with timed("send"):
+                    yield (send_whatsapp_reply, phone, reply)
+            yield (finish_delivery, key, reply)
     except Exception as e:
+        yield (abandon_delivery, key)
         print("WhatsApp webhook error:", e)
     return "ok", 200
 
@@ -478,80 +2585,101 @@ def instagram_webhook():
 
 @app.route('/webhook/sms', methods=['POST'])
 def sms_webhook():
-    try:
-        user_input = request.values.get('Body', '')
-        phone = request.values.get('From', '')
-        reply = get_cloudi_response(user_input)
-        save_sms_log(phone, user_input)
+    return run_flow(sms_flow())
 
-        log_entry = {
-            "from": phone,
-            "question": user_input,
-            "answer": reply,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
+def sms_flow():
+    with request_trace("sms"):
+        key = None
+        try:
+            user_input, phone, message_sid = read_twilio_message()
+            use_account_tenant(request.values.get("To"))
+            key, previous = yield (claim_delivery, "sms", message_sid)
+            if key is None:
+                return twiml_reply(previous), 200  # redelivery: repeat the original answer
+            identity = f"sms:{phone}"
+            if not (yield (allow_message, identity)):
+                reply = yield (throttled_reply, identity)
+                yield (finish_delivery, key, reply)
+                return twiml_reply(reply), 200
 
-        sms_log_file = 'sms_history.json'
-        logs = []
-        if os.path.exists(sms_log_file):
-            with open(sms_log_file, 'r') as f:
-                try:
-                    logs = json.load(f)
-                except:
-                    logs = []
-        logs.append(log_entry)
-        with open(sms_log_file, 'w') as f:
-            json.dump(logs, f, indent=4)
+            # Matching is quick and runs inline; only a GPT fallback races the deadline
+            history = yield (load_conversation, identity)
+            answer = yield from local_answer_flow(user_input)
+            if answer is None:
+                answer = yield (gpt_by_deadline, key, phone, user_input, identity, history)
+                if answer is None:
+                    # Too slow for Twilio: hold the line now, send the answer by SMS later
+                    set_tier("deferred")
+                    return twiml_reply(SMS_HOLDING_REPLY), 200
 
-        return f"<Response><Message>{reply}</Message></Response>", 200
-    except Exception as e:
-        print("SMS webhook error:", e)
-        return "ok", 200
+            yield (remember_turn, identity, user_input, answer.text, answer.faq_key)
+            yield (finish_delivery, key, answer.text)
+            submit_in_context(log_writer, record_sms, phone, user_input, answer.text)
+            return twiml_reply(answer.text), 200
+        except Exception as e:
+            yield (abandon_delivery, key)
+            print("SMS webhook error:", e)
+            return "ok", 200
 
 # ----------- Send Functions (Same) -----------
 
-def send_whatsapp_reply(phone, message):
+# Each send_* has an *_async twin for asgi.py; both build the same request.
+
+def twilio_message(to, message):
     url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_SID}/Messages.json"
     data = {
         "From": TWILIO_PHONE,
-        "To": f"whatsapp:{phone}",
+        "To": to,
         "Body": message
     }
-    requests.post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+    return url, data
 
-def send_facebook_reply(recipient_id, message):
+def graph_message(access_token, recipient_id, text):
     url = "https://graph.facebook.com/v18.0/me/messages"
-    headers = {"Content-Type": "application/json"}
-    params = {"access_token": FB_PAGE_ACCESS_TOKEN}
+    params = {"access_token": access_token}
     payload = {
         "recipient": {"id": recipient_id},
-        "message": {"text": message}
+        "message": {"text": text}
     }
-    requests.post(url, params=params, headers=headers, json=payload)
+    return url, params, payload
+
+def send_whatsapp_reply(phone, message):
+    url, data = twilio_message(f"whatsapp:{phone}", message)
+    get_http().post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+
+async def send_whatsapp_reply_async(phone, message):
+    url, data = twilio_message(f"whatsapp:{phone}", message)
+    await get_async_http().post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+
+def send_facebook_reply(recipient_id, message):
+    url, params, payload = graph_message(FB_PAGE_ACCESS_TOKEN, recipient_id, message)
+    get_http().post(url, params=params, json=payload)
+
+async def send_facebook_reply_async(recipient_id, message):
+    url, params, payload = graph_message(FB_PAGE_ACCESS_TOKEN, recipient_id, message)
+    await get_async_http().post(url, params=params, json=payload)
 
 def send_instagram_reply(user_id, text):
-    url = "https://graph.facebook.com/v18.0/me/messages"
-    headers = {"Content-Type": "application/json"}
-    params = {"access_token": INSTAGRAM_ACCESS_TOKEN}
-    payload = {
-        "recipient": {"id": user_id},
-        "message": {"text": text}
-    }
-    requests.post(url, params=params, headers=headers, json=payload)
+    url, params, payload = graph_message(INSTAGRAM_ACCESS_TOKEN, user_id, text)
+    get_http().post(url, params=params, json=payload)
 
 def send_sms(to, message):
-    url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_SID}/Messages.json"
-    data = {
-        "From": TWILIO_PHONE,
-        "To": to,
-        "Body": message
-    }
-    requests.post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+    url, data = twilio_message(to, message)
+    get_http().post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+
+async def send_sms_async(to, message):
+    url, data = twilio_message(to, message)
+    await get_async_http().post(url, data=data, auth=(TWILIO_SID, TWILIO_TOKEN))
+
+# Everything loaded at import is long-lived: with `gunicorn --preload` freezing
+# it keeps the GC from touching those pages, so forked workers share them
+# copy-on-write instead of each getting a private copy.
+gc.freeze()
 
 # ----------- Run App -----------
 if __name__ == "__main__":
     print("🚀 Starting Cloudi Chatbot...")
-    print(f"📚 FAQ entries: {len(faq)}")
+    print(f"📚 FAQ entries: {len(knowledge_bases.get(DEFAULT_TENANT).faq)} ({len(tenants)} tenant(s))")
     print(f"💬 Casual replies: {len(casual_replies)}")
 
 # app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,191 @@
+# asgi.py – Async serving mode for Cloudi ☁️
+#
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+#
+# The chat and webhook routes run on the event loop and await the async LLM
+# and HTTP clients, so a slow GPT or Twilio call holds a coroutine instead of
+# a whole worker process. Every other route (pages, admin, static files) is
+# the normal Flask app, run in a thread pool through asgiref's WsgiToAsgi.
+#
+# The handlers themselves are the flows in app.py, shared with the WSGI views:
+# here each call a flow yields is awaited through its async twin (the LLM and
+# HTTP calls), and anything else that may block - the rate limiter, dedup and
+# conversation stores (SQLite with SHARED_STATE_DB), opening a tenant's FAQ,
+# reloading warm answers, file writes, template rendering - runs in a worker
+# thread. Flows run inside a real Flask request
+# context, so sessions, flash(), url_for() and the templates all behave
+# exactly as under WSGI.
+
+import asyncio
+import io
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as cloudi
+
+# ----------- Async flow runner -----------
+
+async def run_flow_async(flow):
+    """cloudi.run_flow() for the event loop."""
+    result, error = None, None
+    while True:
+        try:
+            call = flow.throw(error) if error is not None else flow.send(result)
+        except StopIteration as done:
+            return done.value
+        fn, *args = call
+        twin = ASYNC_TWINS.get(fn)
+        try:
+            result = await (twin(*args) if twin else asyncio.to_thread(fn, *args))
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+async def gpt_by_deadline(key, phone, user_input, identity, history):
+    flow = cloudi.llm_answer_flow(user_input, identity=identity, history=history)
+    task = asyncio.ensure_future(run_flow_async(flow))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), cloudi.SMS_DEADLINE_SECONDS)
+    except asyncio.TimeoutError:
+        late = asyncio.ensure_future(deliver_late_sms(key, phone, user_input, identity, task))
+        background_tasks.add(late)
+        late.add_done_callback(background_tasks.discard)
+        return None
+
+# Strong references so pending late deliveries aren't garbage collected
+background_tasks = set()
+
+async def deliver_late_sms(key, phone, user_input, identity, task):
+    try:
+        answer = await task
+        with cloudi.timed("send"):
+            await cloudi.send_sms_async(phone, answer.text)
+    except Exception as e:
+        await asyncio.to_thread(cloudi.abandon_delivery, key)
+        print("Late SMS delivery error:", e)
+        return
+    # Sent: from here on a Twilio retry must get this reply, whatever happens to the logging
+    await asyncio.to_thread(cloudi.finish_delivery, key, answer.text)
+    try:
+        await asyncio.to_thread(cloudi.remember_turn, identity, user_input, answer.text)
+        cloudi.submit_in_context(cloudi.log_writer, cloudi.record_sms, phone, user_input, answer.text)
+    except Exception as e:
+        print("Late SMS logging error:", e)
+
+ASYNC_TWINS = {
+    cloudi.get_fallback_from_gpt: cloudi.get_fallback_from_gpt_async,
+    cloudi.send_facebook_reply: cloudi.send_facebook_reply_async,
+    cloudi.send_whatsapp_reply: cloudi.send_whatsapp_reply_async,
+    cloudi.gpt_by_deadline: gpt_by_deadline,
+}
+
+ASYNC_ROUTES = {
+    ("POST", "/chat"): cloudi.chat_flow,
+    ("POST", "/api/chat"): cloudi.api_chat_flow,
+    ("POST", "/webhook/facebook"): cloudi.facebook_flow,
+    ("POST", "/webhook/whatsapp"): cloudi.whatsapp_flow,
+    ("POST", "/webhook/sms"): cloudi.sms_flow,
+}
+
+# ----------- ASGI plumbing -----------
+
+async def read_body(receive):
+    body = bytearray()
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return bytes(body)
+
+def build_environ(scope, body, path, prefix=""):
+    """Translate an ASGI HTTP scope into a WSGI environ for Flask's request context."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": (scope.get("root_path", "") + prefix).encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if prefix:
+        environ["cloudi.tenant"] = cloudi.tenant_prefixes[prefix]
+    environ["cloudi.event_loop"] = True  # not sampled by the profiler
+    return environ
+
+def route_path(scope):
+    """(tenant prefix, path within the app) for an HTTP scope."""
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    prefix = cloudi.tenant_prefix(path) or ""
+    return prefix, path[len(prefix):] or "/"
+
+class CloudiASGI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return await self.wsgi(scope, receive, send)
+        prefix, path = route_path(scope)
+        view = ASYNC_ROUTES.get((scope["method"], path))
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+
+        environ = build_environ(scope, await read_body(receive), path, prefix)
+        with self.flask_app.request_context(environ):
+            try:
+                rv = self.flask_app.preprocess_request()
+                if rv is None:
+                    rv = await run_flow_async(view())
+                response = self.flask_app.make_response(rv)
+            except Exception as e:
+                response = self.flask_app.make_response(self.flask_app.handle_exception(e))
+            response = self.flask_app.process_response(response)
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in response.headers.items()],
+        })
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await cloudi.close_async_http()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+app = CloudiASGI(cloudi.app)
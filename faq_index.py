@@ -0,0 +1,578 @@
+# faq_index.py – Prebuilt FAQ index for fast worker startup ☁️
+#
+# Build it once with `python faq_index.py` (or let the first process do it):
+# workers then open the normalized FAQ and its match structures in place
+# instead of parsing faq_data.json and re-normalizing every key.
+#
+# Layout of faq_index.bin:
+#   header       magic, version, length of the pickled section table
+#   sections     pickled {"signature", "byteorder", "sections": {name: (start, end)}}
+#   data         flat arrays and UTF-8 string tables, each 8-byte aligned
+#
+# Nothing is unpickled per entry: the keys, answers, question wording, typo
+# vocabulary and token postings are all read straight out of the buffer (the
+# mmap'd file, or a shared memory segment - see SharedIndex), so a worker's
+# heap holds a few small wrappers and every worker shares the same pages.
+
+import json
+import mmap
+import os
+import pickle
+import string
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+FAQ_SOURCE = "faq_data.json"
+FAQ_INDEX = "faq_index.bin"
+
+# Bump INDEX_VERSION whenever the layout of the file or pickled index changes.
+INDEX_MAGIC = b"CLOUDIFQ"
+INDEX_VERSION = 5
+_HEADER = struct.Struct("<8sIQ")
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+# Too common to narrow down which FAQ entry a question is about
+STOPWORDS = frozenset("""
+    a about an and are be can do does for how i in is it me my of on or the
+    there this to we what when where which who why will with you your
+""".split())
+
+def normalize(text):
+    if not text:
+        return ""
+    text = text.lower().strip()
+    text = text.translate(_PUNCTUATION)
+    return " ".join(text.split())
+
+def source_signature(source):
+    # Size + mtime is enough to notice an edited faq_data.json without reading it
+    stat = os.stat(source)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+# ----------- Typo tolerance -----------
+
+def edit_distance(a, b, max_distance):
+    """Optimal string alignment distance, or None as soon as it must exceed max_distance."""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before_previous[j - 2] + 1)  # transposition
+            row_min = min(row_min, current[j])
+        if row_min > max_distance:
+            return None
+        before_previous, previous = previous, current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+def _deletes(word, max_distance):
+    variants = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+def allowed_distance(word):
+    # Short words have too many neighbours to correct safely
+    if len(word) <= 2:
+        return 0
+    return 1 if len(word) <= 5 else 2
+
+
+class _SpellLookup:
+    MAX_DISTANCE = 2
+    PREFIX_LENGTH = 7
+
+    def lookup(self, term, max_distance=None):
+        """Return (word, distance) for the closest known word, or (None, None)."""
+        if self.count(term):
+            return term, 0
+        if max_distance is None:
+            max_distance = allowed_distance(term)
+        max_distance = min(max_distance, self.MAX_DISTANCE)
+        best = None
+        for variant in _deletes(term[:self.PREFIX_LENGTH], max_distance):
+            for word in self.candidates(variant):
+                distance = edit_distance(term, word, max_distance)
+                if distance is None:
+                    continue
+                rank = (distance, -self.count(word), word)
+                if best is None or rank < best:
+                    best = rank
+        return (best[2], best[0]) if best else (None, None)
+
+class SpellIndex(_SpellLookup):
+    """SymSpell deletion dictionary: word lookups cost the same however big the vocabulary is.
+
+    Every word is stored under all its deletions (of its first PREFIX_LENGTH
+    characters, up to MAX_DISTANCE); a lookup only generates the deletions of
+    the query and checks the handful of words filed under them.
+    """
+
+    def __init__(self, words=()):
+        self.words = {}
+        self.deletes = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if word in self.words:
+            self.words[word] += 1
+            return
+        self.words[word] = 1
+        for variant in _deletes(word[:self.PREFIX_LENGTH], self.MAX_DISTANCE):
+            self.deletes.setdefault(variant, []).append(word)
+
+    def count(self, word):
+        return self.words.get(word, 0)
+
+    def candidates(self, variant):
+        return self.deletes.get(variant, ())
+
+def tokens(text):
+    return text.split()
+
+# ----------- In-place views over the index buffer -----------
+
+class StringTable(Sequence):
+    """UTF-8 strings stored back to back, decoded on access."""
+
+    def __init__(self, offsets, table):
+        self._offsets = offsets
+        self._table = table
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self._offsets) - 1:
+            raise IndexError(i)
+        return str(self._table[self._offsets[i]:self._offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, value):
+        """Position of `value` in a sorted table, or -1."""
+        i = bisect_left(self, value)
+        return i if i < len(self) and self[i] == value else -1
+
+class IdLists(Sequence):
+    """Variable-length lists of entry ids (CSR layout: offsets into one flat array)."""
+
+    def __init__(self, offsets, ids):
+        self._offsets = offsets
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+class _SortedKeys(Sequence):
+    def __init__(self, keys, order):
+        self._keys = keys
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, i):
+        return self._keys[self._order[i]]
+
+class TableMap(Mapping):
+    """Read-only str -> str mapping over string tables; keys keep their FAQ order."""
+
+    def __init__(self, keys, order, values):
+        self._keys = keys
+        self._sorted = _SortedKeys(keys, order)
+        self._order = order
+        self._values = values
+
+    def _position(self, key):
+        i = bisect_left(self._sorted, key)
+        if i < len(self._sorted) and self._sorted[i] == key:
+            return self._order[i]
+        return -1
+
+    def __getitem__(self, key):
+        i = self._position(key) if isinstance(key, str) else -1
+        if i < 0:
+            raise KeyError(key)
+        return self._values[i]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._position(key) >= 0
+
+class Postings:
+    """token -> ascending ids of the FAQ entries containing it."""
+
+    def __init__(self, tokens, ids):
+        self._tokens = tokens
+        self._ids = ids
+
+    def get(self, token, default=()):
+        i = self._tokens.find(token)
+        return self._ids[i] if i >= 0 else default
+
+class FrozenSpellIndex(_SpellLookup):
+    """SpellIndex read in place: sorted vocabulary and deletions, CSR variant -> word ids."""
+
+    def __init__(self, words, counts, variants, variant_words):
+        self._words = words
+        self._counts = counts
+        self._variants = variants
+        self._variant_words = variant_words
+
+    def count(self, word):
+        i = self._words.find(word)
+        return self._counts[i] if i >= 0 else 0
+
+    def candidates(self, variant):
+        i = self._variants.find(variant)
+        if i < 0:
+            return ()
+        return [self._words[j] for j in self._variant_words[i]]
+
+# ----------- Building and opening -----------
+
+def _pack_strings(strings):
+    offsets = array("Q", [0])
+    table = bytearray()
+    for s in strings:
+        table += s.encode("utf-8")
+        offsets.append(len(table))
+    return offsets, table
+
+def _pack_lists(lists):
+    offsets = array("Q", [0])
+    ids = array("I")
+    for entry_ids in lists:
+        ids.extend(entry_ids)
+        offsets.append(len(ids))
+    return offsets, ids
+
+def _aligned(n):
+    return n + (-n % 8)
+
+def build_payload(raw_faq, signature=""):
+    # Later duplicates win, as they did with a plain dict comprehension
+    answers = {normalize(k): v for k, v in raw_faq.items()}
+    # Original wording of each question, for "Did you mean…" suggestions
+    questions = {normalize(k): k for k in raw_faq}
+    keys = list(answers)
+
+    # Vocabulary for typo correction, and token -> entries for candidate lookup
+    spell = SpellIndex()
+    postings = {}
+    for i, key in enumerate(keys):
+        for token in tokens(key):
+            spell.add(token)
+            if token not in STOPWORDS:
+                ids = postings.setdefault(token, array("I"))
+                if not ids or ids[-1] != i:
+                    ids.append(i)
+    vocabulary = sorted(spell.words)
+    word_ids = {word: i for i, word in enumerate(vocabulary)}
+    variants = sorted(spell.deletes)
+    indexed_tokens = sorted(postings)
+
+    arrays = {}
+    arrays["key_offsets"], arrays["key_table"] = _pack_strings(keys)
+    arrays["key_order"] = array("I", sorted(range(len(keys)), key=keys.__getitem__))
+    arrays["question_offsets"], arrays["question_table"] = _pack_strings(questions[k] for k in keys)
+    arrays["answer_offsets"], arrays["answer_table"] = _pack_strings(answers.values())
+    arrays["word_offsets"], arrays["word_table"] = _pack_strings(vocabulary)
+    arrays["word_counts"] = array("I", (spell.words[w] for w in vocabulary))
+    arrays["variant_offsets"], arrays["variant_table"] = _pack_strings(variants)
+    arrays["variant_word_offsets"], arrays["variant_words"] = _pack_lists(
+        [word_ids[w] for w in spell.deletes[v]] for v in variants
+    )
+    arrays["token_offsets"], arrays["token_table"] = _pack_strings(indexed_tokens)
+    arrays["posting_offsets"], arrays["postings"] = _pack_lists(postings[t] for t in indexed_tokens)
+
+    sections = {}
+    data = bytearray()
+    for name, values in arrays.items():
+        data += bytes(_aligned(len(data)) - len(data))
+        start = len(data)
+        data += bytes(values)
+        sections[name] = (start, len(data))
+
+    meta = pickle.dumps(
+        {"signature": signature, "byteorder": sys.byteorder, "sections": sections},
+        protocol=pickle.HIGHEST_PROTOCOL
+    )
+    header = _HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(meta)) + meta
+    return header + bytes(_aligned(len(header)) - len(header)) + data
+
+def open_index(buffer):
+    """Open a payload (bytes, mmap or shared memory) in place. Returns None if it is corrupt or from another version."""
+    if len(buffer) < _HEADER.size:
+        return None
+    magic, version, meta_length = _HEADER.unpack_from(buffer)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return None
+    data_start = _aligned(_HEADER.size + meta_length)
+    try:
+        meta = pickle.loads(buffer[_HEADER.size:_HEADER.size + meta_length])
+    except Exception:
+        return None
+    sections = meta["sections"]
+    # The arrays are in native byte order; a foreign build just gets rebuilt
+    if meta["byteorder"] != sys.byteorder or data_start + max(end for _, end in sections.values()) > len(buffer):
+        return None
+
+    view = memoryview(buffer)
+
+    def section(name, typecode=None):
+        start, end = sections[name]
+        part = view[data_start + start:data_start + end]
+        return part.cast(typecode) if typecode else part
+
+    def strings(name):
+        return StringTable(section(f"{name}_offsets", "Q"), section(f"{name}_table"))
+
+    keys = strings("key")
+    order = section("key_order", "I")
+    return {
+        "signature": meta["signature"],
+        "size": len(buffer),
+        "keys": keys,
+        "faq": TableMap(keys, order, strings("answer")),
+        "questions": TableMap(keys, order, strings("question")),
+        "spell": FrozenSpellIndex(
+            strings("word"),
+            section("word_counts", "I"),
+            strings("variant"),
+            IdLists(section("variant_word_offsets", "Q"), section("variant_words", "I"))
+        ),
+        "postings": Postings(
+            strings("token"),
+            IdLists(section("posting_offsets", "Q"), section("postings", "I"))
+        ),
+    }
+
+def write_index(payload, path=FAQ_INDEX):
+    # Write then rename so a worker never maps a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def read_index(path=FAQ_INDEX):
+    """Map the stored index read-only, or return None if it is missing or unusable."""
+    try:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # ValueError: empty file
+        return None
+    index = open_index(buffer)
+    if index is None:
+        buffer.close()
+    return index
+
+def build_from_source(source=FAQ_SOURCE):
+    with open(source, "r") as f:
+        return build_payload(json.load(f), source_signature(source))
+
+def load_index(source=FAQ_SOURCE, path=FAQ_INDEX):
+    """Load the FAQ index, rebuilding it from `source` if the artifact is stale.
+
+    Raises FileNotFoundError if `source` does not exist.
+    """
+    signature = source_signature(source)
+    index = read_index(path)
+    if index is not None and index["signature"] == signature:
+        return index
+
+    payload = build_from_source(source)
+    try:
+        write_index(payload, path)
+        index = read_index(path)
+        if index is not None:
+            return index
+    except OSError as e:
+        print(f"⚠️ Could not write FAQ index: {e}")
+    # Read-only filesystem: serve straight from the in-memory payload
+    return open_index(payload)
+
+# ----------- Sharing between workers, reloading -----------
+
+class IndexFile:
+    """faq_index.bin mmap'd read-only; refresh() switches to a replaced file.
+
+    Every worker maps the same file, so the index lives once in the page cache.
+    """
+
+    def __init__(self, source=FAQ_SOURCE, path=FAQ_INDEX):
+        self.source = source
+        self.path = path
+        self.generation = 1
+        self.index = load_index(source, path)
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def refresh(self):
+        stamp = self._file_stamp()
+        if stamp is not None and stamp != self._stamp:
+            index = read_index(self.path)
+            if index is not None:
+                self.index, self._stamp = index, stamp
+                self.generation += 1
+        return self.index
+
+    def reload(self):
+        """Rebuild from the source; every worker switches on its next refresh()."""
+        write_index(build_from_source(self.source), self.path)
+        return self.refresh()
+
+_GENERATION = struct.Struct("<Q")
+
+class _Segment(SharedMemory):
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass  # an index still reads from it; the OS unmaps it at exit
+
+def _untrack(segment):
+    # Segments must outlive the worker that attached them; only a newer generation retires one
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+
+def _attach(name, create_size=None):
+    try:
+        segment = _Segment(name)
+    except FileNotFoundError:
+        if create_size is None:
+            raise
+        try:
+            segment = _Segment(name, create=True, size=create_size)
+        except FileExistsError:
+            segment = _Segment(name)
+    _untrack(segment)
+    return segment
+
+def _unlink(name):
+    try:
+        segment = SharedMemory(name)
+    except FileNotFoundError:
+        return
+    segment.unlink()  # also drops it from the resource tracker
+    segment.close()
+
+def _stored_payload(source, path):
+    """The bytes of faq_index.bin if it is fresh, else a newly built payload."""
+    try:
+        with open(path, "rb") as f:
+            payload = f.read()
+        index = open_index(payload)
+        if index is not None and index["signature"] == source_signature(source):
+            return payload
+    except OSError:
+        pass
+    return build_from_source(source)
+
+class SharedIndex:
+    """The index in POSIX shared memory, published once and attached by every worker.
+
+    The control segment `name` holds the current generation; the index itself
+    is in `<name>_<generation>`. Publishing writes a new generation and then
+    unlinks the old one, whose memory is freed once the last worker detaches.
+    Segments outlive the workers, so a restart reattaches instead of copying.
+    """
+
+    def __init__(self, name, source=FAQ_SOURCE, path=FAQ_INDEX):
+        self.name = name
+        self.source = source
+        self.generation = 0
+        self.index = None
+        self._segment = None
+        self._retired = []
+        self._control = _attach(name, create_size=_GENERATION.size)
+        index = self.refresh()
+        if index is None or index["signature"] != source_signature(source):
+            self.publish(_stored_payload(source, path))
+
+    def published_generation(self):
+        return _GENERATION.unpack_from(self._control.buf)[0]
+
+    def refresh(self):
+        generation = self.published_generation()
+        if generation and generation != self.generation:
+            try:
+                segment = _attach(f"{self.name}_{generation}")
+            except FileNotFoundError:
+                return self.index  # replaced while we looked; pick it up next time
+            index = open_index(segment.buf.toreadonly())
+            if index is None:
+                segment.close()
+            else:
+                if self._segment is not None:
+                    self._retired.append(self._segment)
+                self._segment, self.index, self.generation = segment, index, generation
+        self._close_retired()
+        return self.index
+
+    def _close_retired(self):
+        for segment in list(self._retired):
+            try:
+                segment.close()
+            except BufferError:
+                continue  # a request is still reading the old generation
+            self._retired.remove(segment)
+
+    def publish(self, payload):
+        generation = self.published_generation() + 1
+        try:
+            segment = _Segment(f"{self.name}_{generation}", create=True, size=len(payload))
+        except FileExistsError:
+            return self.refresh()  # another process is publishing this generation
+        _untrack(segment)
+        segment.buf[:len(payload)] = payload
+        segment.close()
+        _GENERATION.pack_into(self._control.buf, 0, generation)
+        _unlink(f"{self.name}_{generation - 1}")
+        return self.refresh()
+
+    def reload(self):
+        """Rebuild from the source and publish it; every worker switches on its next refresh()."""
+        return self.publish(build_from_source(self.source))
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else FAQ_SOURCE
+    path = sys.argv[2] if len(sys.argv) > 2 else FAQ_INDEX
+    with open(source, "r") as f:
+        raw_faq = json.load(f)
+    write_index(build_payload(raw_faq, source_signature(source)), path)
+    print(f"✅ Wrote {len(raw_faq)} FAQ entries to {path}")